@@ -0,0 +1,277 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Benchmark
+# *****************************************************************************
+
+import json
+import time
+import yaml
+import argparse
+import cv2 as cv
+import numpy as np
+
+from config import VIDEO, RENDER
+from layercache import LayerCache
+from markercache import MarkerCache
+from targets import Target, load_targets
+from rendering import Rendering
+from tracking import Tracking, FeatureExtraction, MarkerPyramid, PointTracker
+
+FRAMES = 50
+SCENARIOS = ['pan', 'zoom', 'tilt', 'blur', 'occlusion', 'lighting', 'absent', 'still']
+
+def views(markerImg):
+    # homographies from the marker to the frame for a few typical poses
+    h, w, _ = markerImg.shape
+    fit = min(VIDEO.WIDTH / w, VIDEO.HEIGHT / h)
+    def pose(scale, cx=0.5, cy=0.5, tilt=0.0):
+        s = fit * scale
+        H = np.array([[s, 0, VIDEO.WIDTH / 2 - s * w * cx], [0, s, VIDEO.HEIGHT / 2 - s * h * cy], [0, 0, 1]])
+        return H.dot([[1, 0, 0], [0, 1, 0], [0, tilt / h, 1]])
+    return [
+        ('full', pose(1.0)),
+        ('far', pose(0.3)),
+        ('close', pose(4.0, 0.45, 0.6)),
+        ('tilted', pose(0.9, tilt=0.4)),
+    ]
+
+def bench(rendering, frameImg, H, mode):
+    RENDER.MODE = mode
+    rendering.texture = None
+    for layer in rendering.layers:
+        layer.texture = None
+    rendering.update(H, frameImg.copy())
+    start = time.perf_counter()
+    rendering.renderGeoJSON() # warm up, rasterizes the layers in raster mode
+    setup = time.perf_counter() - start
+    times = []
+    for _ in range(FRAMES):
+        # a moving camera, nothing projected for the last frame holds
+        for layer in rendering.layers:
+            layer.projection = None
+        rendering.update(H, frameImg.copy())
+        start = time.perf_counter()
+        rendering.renderGeoJSON()
+        times.append(time.perf_counter() - start)
+    return setup * 1000, np.median(times) * 1000, np.percentile(times, 95) * 1000
+
+def rendering(path, config):
+    mode = RENDER.MODE
+
+    print("{:<28} {:<7} {:>22} {:>22}".format('layer', 'view', 'vector p50/p95 ms', 'raster p50/p95 ms'))
+    for target in load_targets(path, config):
+        markerImg = cv.cvtColor(target.img, cv.COLOR_BGR2RGB)
+        layers = LayerCache(target.coords)
+        renderings = []
+        for layer in target.layers:
+            rendering = Rendering(markerImg, target.coords)
+            rendering.setLayer(layers.load(path + layer['file']))
+            renderings.append((layer['name'], rendering))
+        # and every layer of the target at once
+        rendering = Rendering(markerImg, target.coords)
+        for z, layer in enumerate(target.layers):
+            rendering.showLayer(layer['name'], layers.load(path + layer['file']), layer.get('opacity'), z)
+        renderings.append(('all layers', rendering))
+        for layer, rendering in renderings:
+            for name, H in views(markerImg):
+                frameImg = cv.warpPerspective(markerImg, H, (VIDEO.WIDTH, VIDEO.HEIGHT))
+                _, v50, v95 = bench(rendering, frameImg, H, 'vector')
+                setup, r50, r95 = bench(rendering, frameImg, H, 'raster')
+                print("{:<28} {:<7} {:>22} {:>22}".format(layer, name,
+                    "{:.2f}/{:.2f}".format(v50, v95),
+                    "{:.2f}/{:.2f} (+{:.0f})".format(r50, r95, setup)))
+    RENDER.MODE = mode
+
+def pose(markerImg, scale=1.0, x=0.0, y=0.0, angle=0.0, tiltX=0.0, tiltY=0.0):
+    # ground truth homography: the marker centered on the frame, offset by
+    # (x, y) pixels, scaled relative to fitting the frame, rotated in plane
+    # and tilted around its center like a camera 1000 pixels away
+    h, w, _ = markerImg.shape
+    s = min(VIDEO.WIDTH / w, VIDEO.HEIGHT / h) * scale
+    f = 1000.0
+    c, d = np.cos(angle), np.sin(angle)
+    A = np.array([[s * c, -s * d, -s * (c * w - d * h) / 2], [s * d, s * c, -s * (d * w + c * h) / 2], [0, 0, 1]])
+    cx, sx, cy, sy = np.cos(tiltX), np.sin(tiltX), np.cos(tiltY), np.sin(tiltY)
+    R = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]).dot([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    P = np.diag([f, f, 1]).dot(R).dot(np.diag([1, 1, f]))
+    T = np.array([[1, 0, VIDEO.WIDTH / 2 + x], [0, 1, VIDEO.HEIGHT / 2 + y], [0, 0, 1]])
+    H = T.dot(P).dot(A)
+    return H / H[2, 2]
+
+def scenario(name, markerImg, frames, rng):
+    # yields the ground truth homography, whether the marker can be seen
+    # and the synthetic BGR frame
+    background = cv.GaussianBlur(rng.integers(60, 200, (VIDEO.HEIGHT, VIDEO.WIDTH, 3)).astype(np.uint8), (0, 0), 5)
+    for i in range(frames):
+        t = i / frames
+        wave = np.sin(2 * np.pi * t)
+        visible = True
+        if name == 'pan':
+            H = pose(markerImg, 0.7, 300 * wave, 100 * np.sin(4 * np.pi * t))
+        elif name == 'zoom':
+            H = pose(markerImg, 0.4 + 1.1 * (0.5 - 0.5 * np.cos(2 * np.pi * t)))
+        elif name == 'tilt':
+            H = pose(markerImg, 0.7, angle=0.2 * wave, tiltX=0.7 * wave, tiltY=0.5 * np.sin(4 * np.pi * t))
+        elif name == 'blur':
+            H = pose(markerImg, 0.7, 300 * wave)
+        elif name == 'occlusion':
+            H = pose(markerImg, 0.7, 100 * wave)
+            visible = not (0.4 <= t < 0.55)
+        elif name == 'lighting':
+            H = pose(markerImg, 0.8, 50 * wave, angle=0.1 * wave)
+        elif name == 'absent':
+            H = pose(markerImg, 0.7)
+            visible = False
+        elif name == 'still':
+            # a mounted camera, then drifting slowly the second half
+            H = pose(markerImg, 0.7, 60 * max(0, t - 0.5))
+        frameImg = cv.warpPerspective(markerImg, H, (VIDEO.WIDTH, VIDEO.HEIGHT), dst=background.copy(), borderMode=cv.BORDER_TRANSPARENT)
+        if name == 'blur':
+            # horizontal motion blur as long as the motion of the frame
+            length = max(1, int(abs(300 * 2 * np.pi / frames * np.cos(2 * np.pi * t))))
+            frameImg = cv.filter2D(frameImg, -1, np.ones((1, length), np.float32) / length)
+        elif name == 'occlusion':
+            if visible:
+                x = int((VIDEO.WIDTH + 500) * t) - 500
+                cv.rectangle(frameImg, (x, 0), (x + 500, VIDEO.HEIGHT), (40, 40, 40), -1)
+            else:
+                frameImg = background.copy()
+        elif name == 'absent':
+            frameImg = background.copy()
+        elif name == 'lighting':
+            gain = 1 + 0.6 * wave
+            gamma = 1 + 0.5 * np.sin(6 * np.pi * t)
+            frameImg = np.uint8(np.clip(255 * (frameImg / 255.0) ** gamma * gain, 0, 255))
+        noise = rng.normal(0, 3, frameImg.shape)
+        frameImg = np.uint8(np.clip(frameImg + noise, 0, 255))
+        yield H, visible, frameImg
+
+def distractors(markerImg, count, seed):
+    # marker sized random textures, other maps the tracking must tell apart
+    rng = np.random.default_rng(seed)
+    h, w, _ = markerImg.shape
+    return [MarkerPyramid(cv.GaussianBlur(rng.integers(0, 256, (h, w, 3)).astype(np.uint8), (0, 0), 2))
+        for _ in range(count)]
+
+def track(markerImg, markers, name, frames, seed):
+    rng = np.random.default_rng(seed)
+    cv.setRNGSeed(seed)
+    h, w, _ = markerImg.shape
+    grid = np.float32([[[x, y] for x in np.linspace(0, w, 5) for y in np.linspace(0, h, 5)]])
+    tracking = Tracking(markers, asynchronous=False)
+    records = []
+    for i, (H, visible, frameImg) in enumerate(scenario(name, markerImg, frames, rng)):
+        frameImg = cv.cvtColor(frameImg, cv.COLOR_BGR2RGB)
+        attempts = tracking.scheduler.attempts
+        start = time.perf_counter()
+        estimate = tracking.update(frameImg)
+        if tracking.target != 0:
+            estimate = None # a distractor
+        latency = (time.perf_counter() - start) * 1000
+        error = None
+        if estimate is not None and visible:
+            error = float(np.linalg.norm(cv.perspectiveTransform(grid, estimate) - cv.perspectiveTransform(grid, H), axis=2).mean())
+        records.append({
+            'frame': i,
+            'visible': visible,
+            'tracked': estimate is not None,
+            'relocalizing': tracking.scheduler.attempts > attempts,
+            'static': tracking.static,
+            'latency': latency,
+            'error': error,
+        })
+    tracking.stop()
+    return summary(records)
+
+def summary(records):
+    latency = np.array([r['latency'] for r in records])
+    errors = np.array([r['error'] for r in records if r['error'] is not None])
+    relocalizing = np.array([r['latency'] for r in records if r['relocalizing']])
+    visible = [r for r in records if r['visible']]
+    # frames from losing the marker, or from the start, until tracking it again
+    recovery, lost = [], 0
+    for r in records:
+        if r['visible'] and not r['tracked']:
+            lost += 1
+        elif r['tracked'] and lost:
+            recovery.append(lost)
+            lost = 0
+    return {
+        'frames': len(records),
+        'tracked': sum(r['tracked'] for r in visible) / max(len(visible), 1),
+        'false_positives': sum(r['tracked'] and not r['visible'] for r in records),
+        'error_mean': float(errors.mean()) if len(errors) else None,
+        'error_p95': float(np.percentile(errors, 95)) if len(errors) else None,
+        'latency_p50': float(np.percentile(latency, 50)),
+        'latency_p95': float(np.percentile(latency, 95)),
+        'latency_p99': float(np.percentile(latency, 99)),
+        'relocalizations': len(relocalizing),
+        'relocalization_mean': float(relocalizing.mean()) if len(relocalizing) else None,
+        'recovery_frames': float(np.mean(recovery)) if recovery else None,
+        'static': sum(r['static'] for r in records) / len(records),
+        'per_frame': records,
+    }
+
+def tracking(path, config, args):
+    if args.nfeatures is not None:
+        FeatureExtraction.orb.setMaxFeatures(args.nfeatures)
+    if args.lowes_ratio is not None:
+        Tracking.LOWES_RATIO = args.lowes_ratio
+    if args.min_matches is not None:
+        Tracking.min_matches = args.min_matches
+    if args.win_size is not None:
+        Tracking.lk_params = dict(Tracking.lk_params, winSize=(args.win_size, args.win_size))
+    if args.max_level is not None:
+        Tracking.lk_params = dict(Tracking.lk_params, maxLevel=args.max_level)
+    if args.points is not None:
+        PointTracker.BUDGET = args.points
+    target = Target(path, config.get('targets', [config])[0])
+    markerImg = target.img
+    markers = [MarkerCache().load(target.file, None if args.single_scale else target.detail)]
+    markers += distractors(markerImg, args.distractors, args.seed)
+
+    results = {}
+    fmt = "{:<10} {:>8} {:>14} {:>20} {:>16} {:>9} {:>7}"
+    print(fmt.format('scenario', 'tracked', 'error mean/p95', 'latency p50/p95/p99', 'reloc n/mean ms', 'recovery', 'static'))
+    for name in args.scenario or SCENARIOS:
+        r = results[name] = track(markerImg, markers, name, args.frames, args.seed)
+        num = lambda v, f='{:.1f}': '-' if v is None else f.format(v)
+        print(fmt.format(name, '{:.0%}'.format(r['tracked']),
+            '{}/{}'.format(num(r['error_mean'], '{:.2f}'), num(r['error_p95'], '{:.2f}')),
+            '{:.1f}/{:.1f}/{:.1f}'.format(r['latency_p50'], r['latency_p95'], r['latency_p99']),
+            '{}/{}'.format(r['relocalizations'], num(r['relocalization_mean'])),
+            num(r['recovery_frames']), '{:.0%}'.format(r['static'])))
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    parser_rendering = subparsers.add_parser('rendering', help='vector and raster renderers on the bundled layers')
+    parser_rendering.add_argument('path', help='data directory with config.yml')
+    parser_tracking = subparsers.add_parser('tracking', help='tracking speed and accuracy on synthetic footage')
+    parser_tracking.add_argument('path', help='data directory with config.yml')
+    parser_tracking.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser_tracking.add_argument('--frames', type=int, default=60, help='frames per scenario')
+    parser_tracking.add_argument('--seed', type=int, default=0)
+    parser_tracking.add_argument('--nfeatures', type=int)
+    parser_tracking.add_argument('--lowes-ratio', type=float)
+    parser_tracking.add_argument('--min-matches', type=int)
+    parser_tracking.add_argument('--win-size', type=int)
+    parser_tracking.add_argument('--max-level', type=int)
+    parser_tracking.add_argument('--points', type=int, help='tracked point budget')
+    parser_tracking.add_argument('--single-scale', action='store_true', help='leave the detail image out of the marker pyramid')
+    parser_tracking.add_argument('--distractors', type=int, default=0, help='random targets to recognize the map among')
+    parser_tracking.add_argument('--report', help='JSON file for the full results')
+    args = parser.parse_args()
+
+    with open(args.path + 'config.yml') as f:
+        config = yaml.safe_load(f)
+    if args.benchmark == 'rendering':
+        rendering(args.path, config)
+    else:
+        tracking(args.path, config, args)
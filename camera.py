@@ -5,30 +5,171 @@
 # * Camera
 # *****************************************************************************
 
+import os
+import glob
 import cv2 as cv
-from threading import Thread
+import time
+import numpy as np
+from threading import Thread, Condition
 
 from config import VIDEO
+from pipeline import Frame
 
 class Camera:
-    def __init__(self):
-        self._stream = cv.VideoCapture(VIDEO.SRC)
+    def __init__(self, src=None, record=None, realtime=True):
+        src = VIDEO.SRC if src is None else src
+        self._stream = open_source(src)
         self._stream.set(cv.CAP_PROP_FRAME_WIDTH, VIDEO.WIDTH)
         self._stream.set(cv.CAP_PROP_FRAME_HEIGHT, VIDEO.HEIGHT)
         self._stream.set(cv.CAP_PROP_FPS, VIDEO.FPS)
-        (self._flag, self._frame) = self._stream.read()
+        # recordings are replayed at their own frame rate unless realtime is off
+        self._period = 0
+        if realtime and is_recording(src):
+            self._period = 1 / (self._stream.get(cv.CAP_PROP_FPS) or VIDEO.FPS)
+        record = VIDEO.RECORD if record is None else record
+        self._recorder = Recorder(record, VIDEO.FPS) if record else None
+        (self._flag, frame) = self._stream.read()
+        shape = frame.shape if self._flag else (VIDEO.HEIGHT, VIDEO.WIDTH, 3)
+        # preallocated ring of frames, the capture thread writes slot
+        # seq % BUFFERS while readers get views of the older slots
+        self._slots = np.zeros((VIDEO.BUFFERS,) + shape, np.uint8)
+        self._timestamps = [0.0] * VIDEO.BUFFERS
+        self._seq = 0
+        self._last = 0
+        self._cond = Condition()
         self._stopped = False
+        self.skipped = 0
+        if self._flag:
+            self.publish(frame)
+            if self._recorder is not None:
+                self._recorder.write(frame)
     
     def start(self):
         Thread(target=self.update, args=()).start()
         return self
     
     def update(self):
+        start = time.monotonic()
         while not self._stopped:
-            self._flag, self._frame = self._stream.read()
+            slot = self._slots[(self._seq + 1) % VIDEO.BUFFERS]
+            flag, frame = self._stream.read(slot)
+            if flag:
+                if self._period:
+                    time.sleep(max(0, start + self._seq * self._period - time.monotonic()))
+                self.publish(frame)
+                if self._recorder is not None:
+                    self._recorder.write(frame)
+            else:
+                time.sleep(1 / VIDEO.FPS)
+            self._flag = flag
+        self._stream.release()
+        if self._recorder is not None:
+            self._recorder.release()
+        with self._cond:
+            self._cond.notify_all()
+
+    def publish(self, frame):
+        i = (self._seq + 1) % VIDEO.BUFFERS
+        if frame.base is not self._slots:
+            if frame.shape != self._slots.shape[1:]:
+                # the device changed resolution, start a new ring
+                self._slots = np.zeros((VIDEO.BUFFERS,) + frame.shape, np.uint8)
+            self._slots[i] = frame
+        with self._cond:
+            self._timestamps[i] = time.monotonic()
+            self._seq += 1
+            self._cond.notify_all()
 
     def read(self):
-        return self._flag, self._frame
+        return self._flag, self._slots[self._seq % VIDEO.BUFFERS]
+
+    def read_next(self, timeout=None):
+        # blocks until a frame newer than the last one returned is captured,
+        # None on timeout or stop; the image is a view of the ring slot and
+        # stays valid until the capture thread wraps around to it
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._last or self._stopped, timeout):
+                return None
+            if self._seq <= self._last:
+                return None
+            self.skipped += self._seq - self._last - 1
+            self._last = seq = self._seq
+            i = seq % VIDEO.BUFFERS
+            return Frame(seq, self._timestamps[i], self._slots[i])
 
     def stop(self):
         self._stopped = True
+
+class ImageSequence:
+    # cv.VideoCapture look-alike over a directory or a glob of images
+    EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+    def __init__(self, pattern, fps=VIDEO.FPS):
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*')
+        self._files = [f for f in sorted(glob.glob(pattern)) if f.lower().endswith(self.EXTENSIONS)]
+        self._fps = fps
+        self._i = 0
+
+    def isOpened(self):
+        return len(self._files) > 0
+
+    def read(self, image=None):
+        # unreadable files are skipped
+        frame = None
+        while frame is None:
+            if self._i >= len(self._files):
+                return False, None
+            frame = cv.imread(self._files[self._i])
+            self._i += 1
+        if image is not None and image.shape == frame.shape:
+            image[:] = frame
+            return True, image
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FPS:
+            return self._fps
+        if prop == cv.CAP_PROP_FRAME_COUNT:
+            return len(self._files)
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
+
+class Recorder:
+    # writes a session as a video file or, for a path without an
+    # extension, as a directory of numbered lossless images
+    def __init__(self, path, fps):
+        self._path = path
+        self._fps = fps
+        self._writer = None
+        self._i = 0
+        if not os.path.splitext(path)[1]:
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, frame):
+        if os.path.splitext(self._path)[1]:
+            if self._writer is None:
+                h, w, _ = frame.shape
+                self._writer = cv.VideoWriter(self._path, cv.VideoWriter_fourcc(*'MJPG'), self._fps, (w, h))
+            self._writer.write(frame)
+        else:
+            cv.imwrite(os.path.join(self._path, '{:06d}.png'.format(self._i)), frame)
+        self._i += 1
+
+    def release(self):
+        if self._writer is not None:
+            self._writer.release()
+
+def is_recording(src):
+    return isinstance(src, str) and (os.path.exists(src) or glob.has_magic(src))
+
+def open_source(src):
+    # webcam index, stream url, video file, image directory or image glob
+    if isinstance(src, str) and (os.path.isdir(src) or glob.has_magic(src)):
+        return ImageSequence(src)
+    return cv.VideoCapture(src)
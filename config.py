@@ -6,17 +6,38 @@
 # *****************************************************************************
 
 class VIDEO:
-    SRC = 0
+    SRC = 0 # webcam index, video file, image directory or glob
+    RECORD = None # video file or directory to record the session to
     WIDTH = 1280
     HEIGHT = 720
     FPS = 30
+    BUFFERS = 4
+
+class PIPELINE:
+    QUEUE_SIZE = 1
+
+class PHOTOS:
+    SIZE = (1280, 720) # the slideshow shows them scaled to fit
+    CACHE = 64 * 2**20 # bytes of scaled photos kept in memory
+    PREFETCH = 2 # photos decoded ahead on each side of the shown one
+    THUMBNAILS = True # keep the scaled photos on disk too
+
+class PROFILE:
+    WINDOW = 300 # samples per stage for the rolling percentiles
+    TRACE_EVENTS = 100000
+    HUD = False
+    TRACE = None # .csv or .json file the trace is exported to on exit
 
 # colors in RGB
 # sizes in pixels
 class RENDER:
+    MODE = 'vector' # or 'raster'
+    RASTER_SCALE = 1
     OPACITY = 0.6
     POINT_COLOR = (255,60,0)
     POINT_RADIUS = 5
+    HIT_TOLERANCE = 4
+    LOD_TOLERANCE = 0.5
     LINE_COLOR = (255,215,0)
     LINE_THICKNESS = 2
     POLYGON_COLOR = (255,139,0)
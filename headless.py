@@ -0,0 +1,115 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Headless
+# *****************************************************************************
+
+import sys
+import json
+import time
+import yaml
+import argparse
+import cv2 as cv
+import numpy as np
+
+from camera import open_source
+from tracking import Tracking
+from rendering import Rendering
+from layercache import LayerCache
+from targets import load_targets
+from profiler import PROFILER
+
+STAGES = ['capture', 'convert', 'tracking', 'rendering']
+
+def run(path, config, source, layers=(), asynchronous=False, limit=None):
+    # every frame of the recording goes through tracking and rendering,
+    # as fast as possible and without Qt; layers are names, stacked as in
+    # the GUI on every target that has them
+    targets = load_targets(path, config)
+    tracking = Tracking([t.marker for t in targets], asynchronous)
+    renderings = [Rendering(t.img, t.coords) for t in targets]
+    for target, rendering in zip(targets, renderings):
+        for z, l in enumerate(target.layers):
+            if l['name'] in layers:
+                rendering.showLayer(l['name'], LayerCache(target.coords).load(path + l['file']), l.get('opacity'), l.get('z', z))
+    stream = open_source(source)
+    PROFILER.reset(window=None)
+    frames = []
+    # both images are reused from frame to frame, like in the GUI pipeline
+    captured, frameImg = None, None
+    while limit is None or len(frames) < limit:
+        times = [time.perf_counter()]
+        flag, captured = stream.read(captured)
+        if not flag:
+            break
+        times.append(time.perf_counter())
+        frameImg = cv.cvtColor(captured, cv.COLOR_BGR2RGB, frameImg if frameImg is not None and frameImg.shape == captured.shape else None)
+        times.append(time.perf_counter())
+        H = tracking.update(frameImg)
+        times.append(time.perf_counter())
+        rendering = renderings[tracking.target]
+        rendering.update(H, frameImg)
+        static = False
+        if H is not None:
+            static = rendering.renderGeoJSON(tracking.static)
+        times.append(time.perf_counter())
+        record = { 'frame': len(frames), 'tracked': H is not None, 'static': static,
+            'target': targets[tracking.target].name if H is not None else None }
+        record.update({ stage: (b - a) * 1000 for stage, a, b in zip(STAGES, times, times[1:]) })
+        frames.append(record)
+    stream.release()
+    tracking.stop()
+    return report(frames, tracking)
+
+def report(frames, tracking):
+    # stage timings in milliseconds
+    stages = {}
+    for stage in STAGES + ['total']:
+        if stage == 'total':
+            times = np.array([sum(f[s] for s in STAGES) for f in frames])
+        else:
+            times = np.array([f[stage] for f in frames])
+        if len(times):
+            stages[stage] = {
+                'mean': float(times.mean()),
+                'p50': float(np.percentile(times, 50)),
+                'p95': float(np.percentile(times, 95)),
+                'p99': float(np.percentile(times, 99)),
+                'max': float(times.max()),
+            }
+    tracked = sum(f['tracked'] for f in frames)
+    return {
+        'frames': len(frames),
+        'tracked': tracked / max(len(frames), 1),
+        'lost': 1 - tracked / max(len(frames), 1),
+        'static': sum(f['static'] for f in frames) / max(len(frames), 1),
+        'attempts': tracking.scheduler.attempts,
+        'relocalizations': tracking.scheduler.successes,
+        'relocalization_time': tracking.scheduler.time * 1000,
+        'stages': stages,
+        'profile': PROFILER.summary(),
+        'per_frame': frames,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='data directory with config.yml')
+    parser.add_argument('source', help='video file, image directory or glob to replay')
+    parser.add_argument('--layer', action='append', default=[], help='name of a layer to render on every target that has it, none by default, repeat for more')
+    parser.add_argument('--async', dest='asynchronous', action='store_true', help='relocalize on a worker like the GUI does')
+    parser.add_argument('--frames', type=int, help='stop after this many frames')
+    parser.add_argument('--report', help='JSON file for the report, stdout by default')
+    args = parser.parse_args()
+
+    with open(args.path + 'config.yml') as f:
+        config = yaml.safe_load(f)
+    result = run(args.path, config, args.source, args.layer, args.asynchronous, args.frames)
+    if args.report is None:
+        json.dump(result, sys.stdout, indent=2)
+    else:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
+        total = result['stages'].get('total', {})
+        print("\033[0;30;102m[INFO]\033[0m {} frames, {:.0%} tracked, {} relocalizations, {:.2f} ms/frame".format(
+            result['frames'], result['tracked'], result['relocalizations'], total.get('mean', 0)))
@@ -5,22 +5,29 @@
 # * Interface
 # *****************************************************************************
 
-import cv2 as cv
-import json
+import time
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtSvg import *
-from PyQt5.QtWebEngineWidgets import *
 
-from config import VIDEO
+from config import VIDEO, PROFILE, PHOTOS
 from camera import Camera
 from tracking import Tracking
-from fps import FPS
+from profiler import PROFILER
 from rendering import Rendering
+from layercache import LayerCache, LayerLoader
+from photocache import PhotoCache
+from targets import load_targets
+from pipeline import Pipeline
 
 class Interface(QWidget):
+    frame_ready = pyqtSignal()
+    camera_ready = pyqtSignal()
+    targets_ready = pyqtSignal()
+
     def __init__(self, path, config):
         QWidget.__init__(self)
 
@@ -32,14 +39,56 @@ class Interface(QWidget):
         self.video_size = QSize(VIDEO.WIDTH, VIDEO.HEIGHT)
         self.setup_ui()
         
-        self.markerImg = cv.imread(self.path + self.config['target'])
-        # cv.imshow("target",targetImg)
-        self._cam = Camera().start()
-        self._track = Tracking(self.markerImg)
-        self._rendering = Rendering(self.markerImg, self.config['coords'])
-        self._fps = FPS()
-        
-        self.setup_render()
+        self._targets = []
+        self._track = None
+        self._renderings = []
+        self._rendering = None
+        self._target = 0
+        self._layers = []
+        self._loader = LayerLoader()
+        self._photos = PhotoCache()
+        self._selected = {}
+        self._pipeline = None
+        self._hud = PROFILE.HUD
+        self._hud_time = 0
+        self._reported = False
+        self._shown = None # anchor of the frame on screen
+        self._closing = False
+        # the camera opens and the markers are prepared on workers while the
+        # window shows up, the video starts untracked as soon as it can
+        self.camera_ready.connect(self.setup_render)
+        self.targets_ready.connect(self.setup_targets)
+        startup = ThreadPoolExecutor(max_workers=2)
+        self._camera = startup.submit(self.open_camera)
+        self._camera.add_done_callback(lambda f: self.camera_ready.emit())
+        self._prepared = startup.submit(self.prepare_targets)
+        self._prepared.add_done_callback(lambda f: self.targets_ready.emit())
+        startup.shutdown(wait=False)
+
+    def open_camera(self):
+        cam = Camera().start()
+        PROFILER.milestone('camera')
+        return cam
+
+    def prepare_targets(self):
+        targets = load_targets(self.path, self.config)
+        PROFILER.milestone('markers')
+        track = Tracking([t.marker for t in targets])
+        track.index.prepare()
+        PROFILER.milestone('index')
+        return targets, track
+
+    def setup_targets(self):
+        # one rendering and layer cache per target, the tracked one is shown
+        if self._closing:
+            return
+        self._targets, self._track = self._prepared.result()
+        self._renderings = [Rendering(t.img, t.coords) for t in self._targets]
+        self._layers = [LayerCache(t.coords) for t in self._targets]
+        self.select_target(0)
+        if self._pipeline is not None:
+            self._pipeline.attach(self._track, self._renderings)
+        PROFILER.milestone('tracking')
 
     def setup_ui(self):
         self.main_layout = QHBoxLayout()
@@ -53,6 +102,8 @@ class Interface(QWidget):
         self.pixmap = QLabel()
         self.pixmap.setFixedSize(self.video_size)
         self.pixmap.mousePressEvent = self.click_pixmap
+        self.pixmap.mouseMoveEvent = self.hover_pixmap
+        self.pixmap.setMouseTracking(True)
         self.center_layout.addWidget(self.pixmap)
 
         ## SOUTH LAYOUT
@@ -92,11 +143,9 @@ class Interface(QWidget):
         self.logo.setMinimumSize(252,129)
         self.logo.setMaximumSize(252,129)
         self.east_layout.addWidget(self.logo)
-        # Buttons
-        for layer in self.config['layers']:
-            btn = QPushButton(layer['name'])
-            btn.clicked.connect(lambda state, x=layer: self.load_layer(x))
-            self.east_layout.addWidget(btn)
+        # Buttons, filled with the layers of the tracked target
+        self.layers_layout = QVBoxLayout()
+        self.east_layout.addLayout(self.layers_layout)
         # Layer Description
         sep = QFrame()
         sep.setFrameShape(QFrame.HLine)
@@ -111,14 +160,38 @@ class Interface(QWidget):
         self.east_layout.addStretch()
         self.fps_label = QLabel()
         self.fps_label.setAlignment(Qt.AlignRight)
+        self.fps_label.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
         self.east_layout.addWidget(self.fps_label)
 
         self.setLayout(self.main_layout)
 
-        self.web = QWebEngineView()
-        self.web.resize(VIDEO.WIDTH, VIDEO.HEIGHT)
-        self.web.move(0,0)
-        self.web.hide()
+        # created on first use, it starts a browser process
+        self.web = None
+
+    def select_target(self, target):
+        self._target = target
+        self._rendering = self._renderings[target]
+        self._rendering.setHighlighted(None)
+        if len(self._targets) > 1:
+            self.setWindowTitle('AR4maps - ' + self._targets[target].name)
+        while self.layers_layout.count():
+            self.layers_layout.takeAt(0).widget().deleteLater()
+        # the layers a target had stay loaded when switching back to it
+        selected = self._selected.setdefault(target, [])
+        for layer in self._targets[target].layers:
+            btn = QPushButton(layer['name'])
+            btn.setCheckable(True)
+            btn.setChecked(layer in selected)
+            btn.toggled.connect(lambda checked, x=layer: self.load_layer(x) if checked else self.unload_layer(x))
+            self.layers_layout.addWidget(btn)
+        layer = selected[-1] if selected else None
+        self.layer_title.setText(layer['name'] if layer is not None else 'Select a layer...')
+        self.layer_description.setText(layer['description'] if layer is not None else '')
+        self.feature_title.setText('<br/>')
+        self.feature_description.setText('<br/><br/><br/><br/><br/>')
+        self.feature_website_btn.hide()
+        self.feature_photos_btn.hide()
+        self.feature_video_btn.hide()
 
     def load_layer(self, layer):
         self.layer_title.setText(layer['name'])
@@ -129,11 +202,28 @@ class Interface(QWidget):
         self.feature_website_btn.hide()
         self.feature_photos_btn.hide()
         self.feature_video_btn.hide()
-        with open(self.path + layer['file']) as json_file:
-            data = json.load(json_file)
-            self._rendering.setGeoJSON(data['features'])
+        self._selected[self._target].append(layer)
+        # the layer shows up partially while it is compiled, above or below
+        # the others as per its z or its place in the config
+        rendering = self._rendering
+        name = layer['name']
+        z = layer.get('z', self._targets[self._target].layers.index(layer))
+        self._loader.load((self._target, name), self._layers[self._target], self.path + layer['file'],
+            lambda geojson: rendering.showLayer(name, geojson, layer.get('opacity'), z))
+
+    def unload_layer(self, layer):
+        selected = self._selected[self._target]
+        selected.remove(layer)
+        self._loader.cancel((self._target, layer['name']))
+        self._rendering.hideLayer(layer['name'])
+        self._rendering.setHighlighted(None)
+        layer = selected[-1] if selected else None
+        self.layer_title.setText(layer['name'] if layer is not None else 'Select a layer...')
+        self.layer_description.setText(layer['description'] if layer is not None else '')
 
     def click_pixmap(self, event):
+        if self._rendering is None:
+            return
         pos = (event.x(), event.y())
         feature = self._rendering.getClickedFeature(pos)
         self.feature_website_btn.hide()
@@ -164,49 +254,116 @@ class Interface(QWidget):
             self.feature_description.setText('')
             self._rendering.setHighlighted(None)
 
+    def hover_pixmap(self, event):
+        if self._rendering is None:
+            return
+        feature = self._rendering.getClickedFeature((event.x(), event.y()))
+        if feature is not None:
+            self.pixmap.setCursor(Qt.PointingHandCursor)
+            self._rendering.setHovered(feature['uuid'])
+        else:
+            self.pixmap.unsetCursor()
+            self._rendering.setHovered(None)
+
     def display_photos(self, photos):
         photos = list(map(lambda x: self.path + x, photos))
-        self.slideshow = SlideShow(photos)
+        self.slideshow = SlideShow(photos, self._photos)
         self.slideshow.show()
 
     def display_video(self, url):
+        if self.web is None:
+            from PyQt5.QtWebEngineWidgets import QWebEngineView
+            self.web = QWebEngineView()
+            self.web.resize(VIDEO.WIDTH, VIDEO.HEIGHT)
+            self.web.move(0,0)
         self.web.load(QUrl(url))
         self.web.show()
 
+    def keyPressEvent(self, event):
+        # H toggles the per-stage timings
+        if event.key() == Qt.Key_H:
+            self._hud = not self._hud
+
     def setup_render(self):
-        self._fps.start()
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.render)
-        self.timer.start(1000 / VIDEO.FPS)
+        if self._closing:
+            return
+        PROFILER.tracing = PROFILE.TRACE is not None
+        PROFILER.start()
+        # tracking and rendering run on the pipeline threads, the signal
+        # queues a render call on the Qt thread for every finished frame
+        self._pipeline = Pipeline(self._camera.result(), self._track, self._renderings)
+        self.frame_ready.connect(self.render)
+        self._pipeline.start(self.frame_ready.emit)
 
     def render(self):
-        _, frameImg = self._cam.read()
-        frameImg = cv.cvtColor(frameImg, cv.COLOR_BGR2RGB)
-        H = self._track.update(frameImg)
-        self._rendering.update(H, frameImg)
-        if(H is not None):
-            # self._rendering.drawBorder()
-            self._rendering.renderGeoJSON()
-            # self._rendering.renderObj()
-
-        image = QImage(frameImg, frameImg.shape[1], frameImg.shape[0], 
-                       frameImg.strides[0], QImage.Format_RGB888)
-        self.pixmap.setPixmap(QPixmap.fromImage(image))
-        self.fps_label.setText("{:.2f} FPS".format(self._fps.update()))
+        frame = self._pipeline.read()
+        if frame is None:
+            return
+        if frame.target != self._target:
+            self.select_target(frame.target)
+        # a static frame looks like the one on screen already, as long as
+        # the frame it is anchored to was displayed and not dropped
+        if not frame.static or frame.anchor != self._shown:
+            frameImg = frame.img
+            with PROFILER.stage('qimage'):
+                image = QImage(frameImg, frameImg.shape[1], frameImg.shape[0], 
+                               frameImg.strides[0], QImage.Format_RGB888)
+                self.pixmap.setPixmap(QPixmap.fromImage(image))
+            self._shown = frame.anchor
+        frame.release()
+        PROFILER.frame()
+        PROFILER.milestone('first frame')
+        if not self._reported and self._track is not None:
+            self._reported = True
+            print("\033[0;30;102m[INFO]\033[0m startup " + ', '.join("{} {:.0f} ms".format(name, t * 1000)
+                for name, t in PROFILER.milestones()))
+        # the label is only refreshed a few times per second
+        now = time.monotonic()
+        if now - self._hud_time > 0.25:
+            self._hud_time = now
+            PROFILER.count('dropped', self._pipeline.dropped())
+            PROFILER.count('buffers', self._pipeline.pool.allocated)
+            if self._hud:
+                self.fps_label.setText(PROFILER.hud())
+            else:
+                self.fps_label.setText("{:.2f} FPS, {:.0f} ms".format(PROFILER.fps(), self._pipeline.latency * 1000))
   
     def closeEvent(self, event):
-        self._cam.stop()
-        self._fps.stop()
-        print("\033[0;30;102m[INFO]\033[0m {:.2f} seconds".format(self._fps.elapsed()))
-        print("\033[0;30;102m[INFO]\033[0m {:.2f} FPS".format(self._fps.fps()))
+        self._closing = True
+        # the camera and the tracking may still be opening on the startup
+        # workers, they are stopped as soon as they are ready
+        self._camera.add_done_callback(lambda f: f.exception() is None and f.result().stop())
+        self._prepared.add_done_callback(lambda f: f.exception() is None and f.result()[1].stop())
+        self._loader.stop()
+        self._photos.stop()
+        if self._pipeline is None:
+            return
+        self._pipeline.stop()
+        PROFILER.count('dropped', self._pipeline.dropped())
+        PROFILER.count('buffers', self._pipeline.pool.allocated)
+        PROFILER.stop()
+        print("\033[0;30;102m[INFO]\033[0m {:.2f} seconds".format(PROFILER.elapsed()))
+        print("\033[0;30;102m[INFO]\033[0m {:.2f} FPS".format(PROFILER.average_fps()))
+        for name, value in PROFILER.counters().items():
+            print("\033[0;30;102m[INFO]\033[0m {} {}".format(name, value))
+        if PROFILE.TRACE is not None:
+            PROFILER.export(PROFILE.TRACE)
+            print("\033[0;30;102m[INFO]\033[0m trace written to {}".format(PROFILE.TRACE))
 
 
 class SlideShow(QWidget):
-    def __init__(self, photos):
+    loaded = pyqtSignal(str)
+
+    def __init__(self, photos, cache):
         super().__init__()
         self.setWindowTitle("Photos")
         self.photos = photos
         self.i = 0
+        # photos are decoded and scaled off the Qt thread, the neighbours
+        # of the shown one ahead of time
+        self.cache = cache
+        self.cache.callback = self.loaded.emit
+        self.loaded.connect(self.photo_loaded)
         self.initUI()
 
     def keyPressEvent(self, event):
@@ -236,9 +393,9 @@ class SlideShow(QWidget):
         self.main_layout.addStretch()
         
         # Next Btn
-        self.prev_btn = QPushButton('⮕')
-        self.prev_btn.clicked.connect(self.prev_image)
-        self.main_layout.addWidget(self.prev_btn)
+        self.next_btn = QPushButton('⮕')
+        self.next_btn.clicked.connect(self.next_image)
+        self.main_layout.addWidget(self.next_btn)
 
         self.show_image()
         self.show()
@@ -252,6 +409,18 @@ class SlideShow(QWidget):
         self.show_image()
 
     def show_image(self):
-        pixmap = QPixmap(self.photos[self.i % len(self.photos)])
-        pixmap = pixmap.scaled(1280, 720, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.pixmap.setPixmap(pixmap)
+        n = len(self.photos)
+        order = [0] + [d for k in range(1, PHOTOS.PREFETCH + 1) for d in (k, -k)]
+        self.cache.want(dict.fromkeys(self.photos[(self.i + d) % n] for d in order))
+        # the last photo stays up until this one is ready
+        img = self.cache.get(self.photos[self.i % n])
+        if img is not None:
+            image = QImage(img, img.shape[1], img.shape[0], img.strides[0], QImage.Format_RGB888)
+            self.pixmap.setPixmap(QPixmap.fromImage(image))
+
+    def photo_loaded(self, filename):
+        if filename == self.photos[self.i % len(self.photos)]:
+            self.show_image()
+
+    def closeEvent(self, event):
+        self.cache.want([])
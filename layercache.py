@@ -0,0 +1,171 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Layer Cache
+# *****************************************************************************
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import traceback
+import numpy as np
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from config import RENDER
+from rendering import GeoJSON
+
+class LayerCache:
+    VERSION = 2
+    DIRNAME = '.cache'
+    # features in the first partial layer, every next one has twice as many
+    PARTIAL = 16
+    KEEP = 4 # compiled entries kept per source, e.g. for targets sharing it
+
+    def __init__(self, coords2pixels):
+        self.coords2pixels = coords2pixels
+        # everything besides the source file that changes the compiled layer
+        self._salt = json.dumps([self.VERSION, coords2pixels, GeoJSON.LOD, RENDER.POINT_COLOR,
+            RENDER.LINE_COLOR, RENDER.POLYGON_COLOR, RENDER.POLYGON_BORDER_COLOR]).encode()
+
+    def load(self, filename):
+        for geojson in self.stream(filename):
+            pass
+        return geojson
+
+    def stream(self, filename, cancelled=lambda: False, partial=True):
+        # yields the layer compiled from more and more features as they are
+        # parsed and the complete one last, only that when it is cached or
+        # without partial; stops early once cancelled() is true
+        with open(filename, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha1(self._salt + data).hexdigest()[:16]
+        root, name = self.location(filename)
+        path = os.path.join(root, name + '-' + key)
+        if os.path.isdir(path):
+            try:
+                geojson = self.read(path)
+            except (OSError, ValueError):
+                pass
+            else:
+                self.touch(path)
+                yield geojson
+                return
+        features = []
+        size = self.PARTIAL
+        for feature in iter_features(data.decode('utf-8')):
+            if cancelled():
+                return
+            features.append(feature)
+            if partial and len(features) == size:
+                yield GeoJSON(list(features), self.coords2pixels)
+                size *= 2
+        if cancelled():
+            return
+        geojson = GeoJSON(features, self.coords2pixels)
+        try:
+            self.write(geojson, root, name, path)
+        except OSError:
+            pass
+        yield geojson
+
+    def location(self, filename):
+        root, name = os.path.split(os.path.abspath(filename))
+        return os.path.join(root, self.DIRNAME), os.path.splitext(name)[0]
+
+    def read(self, path):
+        with open(os.path.join(path, 'features.json')) as f:
+            features = json.load(f)
+        # zero-copy, the arrays stay backed by the page cache
+        arrays = { k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r') for k in GeoJSON.ARRAYS }
+        return GeoJSON.fromArrays(features, arrays)
+
+    def touch(self, path):
+        # the most recently used entries are the ones kept
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def write(self, geojson, root, name, path):
+        tmp = path + '.tmp%d' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        features = [{
+            'type': f.get('type', 'Feature'),
+            'uuid': f['uuid'],
+            'properties': f['properties'],
+            'geometry': { 'type': f['geometry']['type'] }
+        } for f in geojson.features]
+        with open(os.path.join(tmp, 'features.json'), 'w') as f:
+            json.dump(features, f)
+        for k, array in geojson.arrays().items():
+            np.save(os.path.join(tmp, k + '.npy'), np.ascontiguousarray(array))
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        # drop the least recently used entries of the same source, the older
+        # versions of it end up there; the ones other processes are still
+        # writing are left alone
+        entries = [os.path.join(root, entry) for entry in os.listdir(root)
+            if entry.rsplit('-', 1)[0] == name and '.tmp' not in entry]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[self.KEEP:]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+class LayerLoader:
+    # compiles layers on a worker thread, one at a time, so the video never
+    # waits for them; callback gets every layer LayerCache.stream yields,
+    # on the worker. A new load for the same key cancels the previous one
+    # and no callback of a cancelled load runs once cancel returns
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._loads = {}
+        self._lock = Lock()
+
+    def load(self, key, cache, filename, callback):
+        self.cancel(key)
+        cancel = self._loads[key] = Event()
+        self._executor.submit(self.run, cache, filename, callback, cancel)
+
+    def cancel(self, key):
+        with self._lock:
+            if key in self._loads:
+                self._loads.pop(key).set()
+
+    def run(self, cache, filename, callback, cancel):
+        # a raster layer is rasterized whole for every partial one, the
+        # complete layer alone is cheaper
+        try:
+            for geojson in cache.stream(filename, cancel.is_set, RENDER.MODE != 'raster'):
+                with self._lock:
+                    if cancel.is_set():
+                        return
+                    callback(geojson)
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        for key in list(self._loads):
+            self.cancel(key)
+        self._executor.shutdown(wait=False)
+
+def iter_features(text):
+    # the features of a FeatureCollection one by one, each decoded as soon
+    # as it is reached instead of after the whole document
+    decoder = json.JSONDecoder()
+    match = re.search(r'"features"\s*:\s*\[', text)
+    if match is None:
+        yield from json.loads(text)['features']
+        return
+    separator = re.compile(r'[\s,]*')
+    i = match.end()
+    while True:
+        i = separator.match(text, i).end()
+        if text[i] == ']':
+            return
+        feature, i = decoder.raw_decode(text, i)
+        yield feature
@@ -5,16 +5,42 @@
 # * Main
 # *****************************************************************************
 
+import time
+START = time.perf_counter()
+
 import sys
 import yaml
+import argparse
+from PyQt5.QtCore import Qt, QCoreApplication
 from PyQt5.QtWidgets import QApplication
 
+from config import VIDEO, PROFILE
+from profiler import PROFILER
 from interface import Interface
 
 if __name__ == "__main__": 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='data directory with config.yml')
+    parser.add_argument('--source', help='video file, image directory or glob to replay instead of the webcam')
+    parser.add_argument('--record', help='video file or directory to record the camera to')
+    parser.add_argument('--hud', action='store_true', help='show per-stage timings, toggled with H')
+    parser.add_argument('--trace', help='.csv or .json file to export the stage timings to on exit')
+    args, _ = parser.parse_known_args()
+    if args.source is not None:
+        VIDEO.SRC = args.source
+    VIDEO.RECORD = args.record
+    PROFILE.HUD = PROFILE.HUD or args.hud
+    if args.trace is not None:
+        PROFILE.TRACE = args.trace
+
+    PROFILER.origin = START
+    PROFILER.milestone('imports')
+    # lets the web view be imported after the application is created
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
-    with open(sys.argv[1] + 'config.yml') as f:
+    with open(args.path + 'config.yml') as f:
         config = yaml.safe_load(f)
-        win = Interface(sys.argv[1], config)
+        win = Interface(args.path, config)
         win.show()
+    PROFILER.milestone('window')
     sys.exit(app.exec_())
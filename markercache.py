@@ -0,0 +1,83 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Marker Cache
+# *****************************************************************************
+
+import os
+import json
+import hashlib
+import cv2 as cv
+import numpy as np
+
+from tracking import MarkerPyramid, FeatureExtraction
+
+class MarkerCache:
+    VERSION = 3
+    DIRNAME = '.cache'
+    KEEP = 4 # databases kept per marker, with and without detail or configs
+
+    def __init__(self):
+        # everything besides the images that changes the marker features
+        orb = FeatureExtraction.orb
+        self._salt = json.dumps([self.VERSION, MarkerPyramid.SCALES, orb.getMaxFeatures(), orb.getScaleFactor(),
+            orb.getNLevels(), orb.getEdgeThreshold(), orb.getFirstLevel(), orb.getWTA_K(),
+            int(orb.getScoreType()), orb.getPatchSize(), orb.getFastThreshold()]).encode()
+
+    def load(self, filename, detail=None):
+        # pyramid of the marker in filename, with the levels above the
+        # marker resolution taken from the detail image when there is one
+        data = [self.read_file(filename)]
+        if detail is not None:
+            data.append(self.read_file(detail))
+        key = hashlib.sha1(self._salt + b''.join(hashlib.sha1(d).digest() for d in data)).hexdigest()[:16]
+        root, name = self.location(filename)
+        path = os.path.join(root, name + '-' + key + '.npz')
+        if os.path.isfile(path):
+            try:
+                pyramid = self.read(path)
+                self.touch(path)
+                return pyramid
+            except (OSError, ValueError, KeyError):
+                pass
+        imgs = [cv.imdecode(np.frombuffer(d, np.uint8), cv.IMREAD_COLOR) for d in data]
+        pyramid = MarkerPyramid(*imgs)
+        try:
+            self.write(pyramid, root, name, path)
+        except OSError:
+            pass
+        return pyramid
+
+    def read_file(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def location(self, filename):
+        root, name = os.path.split(os.path.abspath(filename))
+        return os.path.join(root, self.DIRNAME), os.path.splitext(name)[0]
+
+    def read(self, path):
+        with np.load(path) as arrays:
+            return MarkerPyramid.fromArrays({ k: arrays[k] for k in MarkerPyramid.ARRAYS })
+
+    def touch(self, path):
+        # the most recently used databases are the ones kept
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def write(self, pyramid, root, name, path):
+        os.makedirs(root, exist_ok=True)
+        tmp = path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, **pyramid.arrays())
+        os.replace(tmp, path)
+        # drop the least recently used databases of the same marker, the
+        # older versions of it end up there
+        entries = [os.path.join(root, entry) for entry in os.listdir(root)
+            if entry.endswith('.npz') and entry.rsplit('-', 1)[0] == name]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[self.KEEP:]:
+            os.remove(entry)
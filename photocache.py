@@ -0,0 +1,123 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Photo Cache
+# *****************************************************************************
+
+import os
+import hashlib
+import traceback
+import numpy as np
+from collections import OrderedDict
+from threading import Thread, Condition
+from PIL import Image
+
+from config import PHOTOS
+
+class PhotoCache:
+    # photos scaled to fit PHOTOS.SIZE, as RGB arrays, the least recently
+    # used dropped beyond PHOTOS.CACHE bytes. A worker thread decodes the
+    # wanted ones, most wanted first, and calls callback(filename) with
+    # every one that is ready
+    DIRNAME = '.cache'
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._wanted = []
+        self._failed = set()
+        self._cond = Condition()
+        self._stopped = False
+        Thread(target=self.update, args=(), name='photos', daemon=True).start()
+
+    def get(self, filename):
+        # the scaled photo, None while it is not ready
+        with self._cond:
+            img = self._images.get(filename)
+            if img is not None:
+                self._images.move_to_end(filename)
+            return img
+
+    def want(self, filenames):
+        # replaces the photos to have ready, the first one first
+        with self._cond:
+            self._wanted = list(filenames)
+            self._cond.notify()
+
+    def update(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped or self.next() is not None)
+                if self._stopped:
+                    return
+                filename = self.next()
+            try:
+                img = self.load(filename)
+            except Exception:
+                traceback.print_exc()
+                with self._cond:
+                    self._failed.add(filename)
+                continue
+            with self._cond:
+                self._images[filename] = img
+                self._bytes += img.nbytes
+                while self._bytes > PHOTOS.CACHE and len(self._images) > 1:
+                    self._bytes -= self._images.popitem(last=False)[1].nbytes
+            if self.callback is not None:
+                self.callback(filename)
+
+    def next(self):
+        for filename in self._wanted:
+            if filename not in self._images and filename not in self._failed:
+                return filename
+        return None
+
+    def load(self, filename):
+        path = self.location(filename) if PHOTOS.THUMBNAILS else None
+        if path is not None and os.path.isfile(path):
+            try:
+                with Image.open(path) as img:
+                    return np.array(img.convert('RGB'))
+            except OSError:
+                pass
+        with Image.open(filename) as img:
+            # JPEGs are decoded at 1/2, 1/4 or 1/8 when still big enough
+            img.draft('RGB', PHOTOS.SIZE)
+            img = img.convert('RGB')
+        w, h = PHOTOS.SIZE
+        s = min(w / img.width, h / img.height)
+        img = img.resize((max(int(img.width * s), 1), max(int(img.height * s), 1)), Image.LANCZOS)
+        if path is not None:
+            try:
+                self.write(img, path)
+            except OSError:
+                pass
+        return np.array(img)
+
+    def location(self, filename):
+        # thumbnails are keyed on the file metadata, hashing whole photos
+        # would cost about as much as decoding them
+        stat = os.stat(filename)
+        root, name = os.path.split(os.path.abspath(filename))
+        name = os.path.splitext(name)[0]
+        key = hashlib.sha1(repr((stat.st_mtime_ns, stat.st_size, PHOTOS.SIZE)).encode()).hexdigest()[:16]
+        return os.path.join(root, self.DIRNAME, name + '-' + key + '.jpg')
+
+    def write(self, img, path):
+        root = os.path.dirname(path)
+        os.makedirs(root, exist_ok=True)
+        tmp = path + '.tmp%d' % os.getpid()
+        img.save(tmp, 'JPEG', quality=90)
+        os.replace(tmp, path)
+        # drop thumbnails of older versions of the same photo
+        name = os.path.basename(path).rsplit('-', 1)[0]
+        for entry in os.listdir(root):
+            if entry.endswith('.jpg') and entry.rsplit('-', 1)[0] == name and os.path.join(root, entry) != path:
+                os.remove(os.path.join(root, entry))
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
@@ -0,0 +1,196 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Pipeline
+# *****************************************************************************
+
+import time
+import cv2 as cv
+import numpy as np
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from config import PIPELINE
+from profiler import PROFILER
+
+class Frame:
+    __slots__ = ('seq', 'timestamp', 'img', 'H', 'target', 'static', 'anchor', 'pool')
+
+    def __init__(self, seq, timestamp, img, pool=None):
+        self.seq = seq
+        self.timestamp = timestamp # capture time, time.monotonic()
+        self.img = img
+        self.H = None
+        self.target = 0
+        self.static = False # same picture as the previous frame
+        self.anchor = seq # seq of the last frame rendered in full
+        self.pool = pool # where img goes back to, None when not owned
+
+    def release(self):
+        # hands the image back to its pool, the frame is done with
+        if self.pool is not None:
+            self.pool.release(self.img)
+            self.pool = None
+        self.img = None
+
+class BufferPool:
+    # images reused from frame to frame, new ones are only allocated while
+    # warming up or after the frame size changed
+    def __init__(self):
+        self._free = []
+        self._lock = Lock()
+        self.allocated = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        with self._lock:
+            while self._free:
+                buf = self._free.pop()
+                if buf.shape == shape and buf.dtype == dtype:
+                    return buf
+            self.allocated += 1
+        return np.empty(shape, dtype)
+
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+class FrameQueue:
+    # bounded queue that drops the oldest item to make room for a new one
+    def __init__(self, maxsize=PIPELINE.QUEUE_SIZE):
+        self._items = deque()
+        self._maxsize = maxsize
+        self._cond = Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self._maxsize:
+                self._items.popleft().release()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        # None on timeout or once the queue is closed and drained
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self._closed, timeout)
+            return self._items.popleft() if self._items else None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class Stage:
+    # read is FrameQueue.get or any other blocking read(timeout=...)
+    def __init__(self, name, func, read, outq, callback=None):
+        self.name = name
+        self._func = func
+        self._read = read
+        self._outq = outq
+        self._callback = callback
+        self._stopped = False
+
+    def start(self):
+        Thread(target=self.update, args=(), name=self.name, daemon=True).start()
+        return self
+
+    def update(self):
+        while not self._stopped:
+            item = self._read(timeout=0.1)
+            if item is None:
+                continue
+            item = self._func(item)
+            if item is not None:
+                self._outq.put(item)
+                if self._callback is not None:
+                    self._callback()
+
+    def stop(self):
+        self._stopped = True
+
+class Pipeline:
+    # camera -> tracking -> rendering -> output, every stage on its own
+    # thread so consecutive frames overlap; the display only blits output.
+    # Frames get an RGB image of the pool in the tracking stage and own it
+    # from then on, whoever drops a frame releases it: a full queue or the
+    # reader of the output once it is done with the image
+    def __init__(self, camera, tracking, renderings):
+        # one rendering per target of the tracking, both may come later
+        # with attach
+        self._cam = camera
+        self._track = tracking
+        self._renderings = renderings
+        self.pool = BufferPool()
+        self.tracked = FrameQueue()
+        self.output = FrameQueue()
+        self.latency = 0
+        self._anchor = -1
+        self._stages = []
+
+    def attach(self, tracking, renderings):
+        # tracking starts with the next frame, until then frames go through
+        # untracked; the renderings are in place before tracking can pick one
+        self._renderings = renderings
+        self._track = tracking
+
+    def start(self, callback=None):
+        self._stages = [
+            Stage('tracking', self.track, self._cam.read_next, self.tracked).start(),
+            Stage('rendering', self.render, self.tracked.get, self.output, callback).start(),
+        ]
+        return self
+
+    def track(self, frame):
+        PROFILER.record('capture age', time.monotonic() - frame.timestamp)
+        # converting copies the frame out of the camera ring
+        with PROFILER.stage('rgb'):
+            frame.img = cv.cvtColor(frame.img, cv.COLOR_BGR2RGB, self.pool.acquire(frame.img.shape))
+            frame.pool = self.pool
+        track = self._track
+        if track is None:
+            return frame
+        with PROFILER.stage('tracking'):
+            frame.H = track.update(frame.img)
+        frame.target = track.target
+        frame.static = track.static
+        return frame
+
+    def render(self, frame):
+        renderings = self._renderings
+        if renderings:
+            rendering = renderings[frame.target]
+            rendering.update(frame.H, frame.img)
+            if(frame.H is not None):
+                with PROFILER.stage('rendering'):
+                    frame.static = rendering.renderGeoJSON(frame.static)
+        # static frames only match the frame they were anchored to, the
+        # display still has to show that one when it was dropped on the way
+        if frame.static and frame.H is not None:
+            frame.anchor = self._anchor
+        else:
+            frame.static = False
+            self._anchor = frame.seq
+        return frame
+
+    def read(self):
+        # latest rendered frame, None when there is nothing new; release it
+        # once its image was displayed
+        frame = self.output.get(timeout=0)
+        if frame is not None:
+            self.latency = time.monotonic() - frame.timestamp
+            PROFILER.record('latency', self.latency)
+        return frame
+
+    def dropped(self):
+        # frames never displayed, skipped by the camera or a full queue
+        return self._cam.skipped + self.tracked.dropped + self.output.dropped
+
+    def stop(self):
+        for stage in self._stages:
+            stage.stop()
+        self._cam.stop()
+        if self._track is not None:
+            self._track.stop()
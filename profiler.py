@@ -0,0 +1,145 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Profiler
+# *****************************************************************************
+
+import csv
+import json
+import time
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from config import PROFILE
+
+class Profiler:
+    # rolling per-stage timings on the monotonic clock, all in seconds
+    def __init__(self, window=PROFILE.WINDOW):
+        self._window = window
+        self._samples = {}
+        self._trace = deque(maxlen=PROFILE.TRACE_EVENTS)
+        self._lock = Lock()
+        self._start = None
+        self._end = None
+        self._frames = deque(maxlen=window)
+        self._numFrames = 0
+        self._milestones = {}
+        self._counters = {}
+        self.origin = time.perf_counter() # of the milestones, main moves it back
+        self.tracing = False
+
+    def start(self):
+        self._start = time.perf_counter()
+        return self
+
+    def reset(self, window=PROFILE.WINDOW):
+        # window=None keeps every sample
+        with self._lock:
+            self._window = window
+            self._samples = {}
+            self._trace.clear()
+            self._frames = deque(maxlen=window)
+            self._numFrames = 0
+            self._counters = {}
+
+    def stop(self):
+        self._end = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start)
+
+    def record(self, name, duration, start=None):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self._window)
+            samples.append(duration)
+            if self.tracing:
+                self._trace.append((name, time.perf_counter() - duration if start is None else start, duration))
+
+    def milestone(self, name):
+        # startup steps, only the first time each is reached counts
+        now = time.perf_counter()
+        with self._lock:
+            self._milestones.setdefault(name, now)
+
+    def milestones(self):
+        # (name, seconds since origin) in the order they were reached
+        with self._lock:
+            return sorted(((k, t - self.origin) for k, t in self._milestones.items()), key=lambda m: m[1])
+
+    def count(self, name, value):
+        # running totals kept by their owners, e.g. the dropped frames
+        with self._lock:
+            self._counters[name] = value
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def frame(self):
+        # called once per displayed frame
+        now = time.perf_counter()
+        with self._lock:
+            self._frames.append(now)
+            self._numFrames += 1
+
+    def fps(self):
+        with self._lock:
+            frames = list(self._frames)
+        if len(frames) < 2:
+            return 0.0
+        return (len(frames) - 1) / (frames[-1] - frames[0])
+
+    def elapsed(self):
+        return (self._end or time.perf_counter()) - self._start
+
+    def average_fps(self):
+        return self._numFrames / self.elapsed()
+
+    def summary(self):
+        # milliseconds per stage over the rolling window
+        with self._lock:
+            samples = { k: np.array(v) * 1000 for k, v in self._samples.items() }
+        return { k: {
+            'count': len(v),
+            'mean': float(v.mean()),
+            'p50': float(np.percentile(v, 50)),
+            'p95': float(np.percentile(v, 95)),
+            'p99': float(np.percentile(v, 99)),
+        } for k, v in samples.items() if len(v) }
+
+    def hud(self):
+        lines = ["{:.2f} FPS".format(self.fps())]
+        lines += ["{:<14} {:>6.1f} {:>6.1f} {:>6.1f}".format(k, s['p50'], s['p95'], s['p99'])
+            for k, s in self.summary().items()]
+        lines += ["{:<14} {:>6}".format(k, v) for k, v in self.counters().items()]
+        return '\n'.join(lines)
+
+    def export(self, filename):
+        # CSV gets one row per traced event, JSON the summary and the events
+        with self._lock:
+            trace = list(self._trace)
+        if filename.endswith('.csv'):
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage', 'start', 'duration'])
+                writer.writerows(trace)
+        else:
+            with open(filename, 'w') as f:
+                json.dump({
+                    'summary': self.summary(),
+                    'startup': dict(self.milestones()),
+                    'counters': self.counters(),
+                    'events': [{ 'stage': n, 'start': s, 'duration': d } for n, s, d in trace],
+                }, f, indent=2)
+
+PROFILER = Profiler()
@@ -7,25 +7,35 @@
 
 import cv2 as cv
 import numpy as np
-import math
 import uuid 
+from bisect import bisect_left
+from threading import Lock
 from PIL import ImageColor
 
 from config import RENDER
+from profiler import PROFILER
 
 class Rendering:
     def __init__(self, markerImg, coords2pixels):
         self.coords2pixels = coords2pixels
         self.K = np.array([[1642, 0, 1176], [0, 1642, 714], [0, 0, 1]])
         self.H = None
-        self.geojson = None
+        self.layers = [] # bottom to top
+        self._lock = Lock() # between the writers of the layers
         self.h, self.w, _ = markerImg.shape
         self.frameImg = None
         self.highlighted = None
+        self.hovered = None
+        self.texture = None
+        self.composited = None
+        self.buffers = {}
 
     def update(self, H, frameImg):
         self.H = H
         self.frameImg = frameImg
+        if H is None:
+            # nothing composited before losing the marker is reused after
+            self.composited = None
 
     def drawBorder(self):
         pts = [[0,0],[self.w,0],[self.w,self.h],[0,self.h]]
@@ -36,129 +46,567 @@ class Rendering:
         cv.line(self.frameImg, pts[2], pts[3], (0,255,0), 3, cv.LINE_AA)
         cv.line(self.frameImg, pts[3], pts[0], (0,255,0), 3, cv.LINE_AA)
 
-    def setGeoJSON(self, features):
-        self.geojson = GeoJSON(features, self.coords2pixels)
-
-    def renderGeoJSON(self):
-        if self.geojson is not None:
-            overlayImg = self.frameImg.copy()
-            for f in self.geojson.features:
-                props = f['properties']
-                geo = f['geometry']
-                color = ImageColor.getcolor(props['fill'], 'RGB') if 'fill' in props else None
-                # print(geo,props)
-                if geo['type'] == 'Point':
-                    color = color or RENDER.POINT_COLOR
-                    pts = np.float32([[geo['coordinates']]])
-                    pts = cv.perspectiveTransform(pts, self.H)[0][0]
-                    pts = tuple(pts)
-                    cv.circle(overlayImg, pts, RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
-                    if self.highlighted == f['uuid']:
-                        cv.circle(self.frameImg, pts, RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
-                        cv.circle(self.frameImg, pts, RENDER.POINT_RADIUS + 13, color, 3, cv.LINE_AA)
-                elif geo['type'] == 'MultiPoint':
-                    color = color or RENDER.LINE_COLOR
-                    for pts in geo['coordinates']:
-                        pts = np.float32([[pts]])
-                        pts = cv.perspectiveTransform(pts, self.H)[0][0]
-                        pts = tuple(pts)
-                        cv.circle(overlayImg, pts, RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
-                        if self.highlighted == f['uuid']:
-                            cv.circle(self.frameImg, pts, RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
-                            cv.circle(self.frameImg, pts, RENDER.POINT_RADIUS + 13, color, 3, cv.LINE_AA)     
-                elif geo['type'] == 'LineString':
-                    color = color or RENDER.LINE_COLOR
-                    pts = np.float32([geo['coordinates']])
-                    pts = cv.perspectiveTransform(pts, self.H)[0]
-                    cv.polylines(overlayImg, np.int32([pts]), False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)
-                    if self.highlighted == f['uuid']:
-                        cv.polylines(self.frameImg, np.int32([pts]), False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)
-                elif geo['type'] == 'MultiLineString':
-                    color = color or RENDER.LINE_COLOR
-                    for pts in geo['coordinates']:
-                        pts = np.float32([pts])
-                        pts = cv.perspectiveTransform(pts, self.H)[0]
-                        cv.polylines(overlayImg, np.int32([pts]), False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)
-                        if self.highlighted == f['uuid']:
-                            cv.polylines(self.frameImg, np.int32([pts]), False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)        
-                elif geo['type'] == 'Polygon':
-                    pts = np.float32([geo['coordinates'][0]])
-                    pts = cv.perspectiveTransform(pts, self.H)[0]
-                    if color is None:
-                        cv.polylines(overlayImg, np.int32([pts]), False, RENDER.POLYGON_BORDER_COLOR, RENDER.LINE_THICKNESS, cv.LINE_AA)    
-                        color = RENDER.POLYGON_COLOR
-                    cv.fillPoly(overlayImg, np.int32([pts]), color, cv.LINE_AA)
-                    if self.highlighted == f['uuid']:
-                        cv.fillPoly(self.frameImg, np.int32([pts]), color, cv.LINE_AA)
-                elif geo['type'] == 'MultiPolygon':
-                    color = color or RENDER.POLYGON_COLOR
-                    for pts in geo['coordinates']:
-                        pts = np.float32(pts)
-                        pts = cv.perspectiveTransform(pts, self.H)[0]
-                        if color == RENDER.POLYGON_COLOR:
-                            cv.polylines(overlayImg, np.int32([pts]), False, RENDER.POLYGON_BORDER_COLOR, RENDER.LINE_THICKNESS, cv.LINE_AA)    
-                        cv.fillPoly(overlayImg, np.int32([pts]), color, cv.LINE_AA)
-                        if self.highlighted == f['uuid']:
-                            cv.fillPoly(self.frameImg, np.int32([pts]), color, cv.LINE_AA)
-            cv.addWeighted(overlayImg, RENDER.OPACITY, self.frameImg, 1 - RENDER.OPACITY, 0, self.frameImg)
+    def setLayer(self, geojson):
+        # the only layer, or none
+        with self._lock:
+            self.layers = [Layer(None, geojson)] if geojson is not None else []
+
+    def showLayer(self, name, geojson, opacity=None, z=0):
+        # adds the layer or replaces the one with the same name; the stack is
+        # replaced as a whole so a frame reads it once without locking, the
+        # lock keeps the loader and the Qt thread from undoing each other
+        layer = Layer(name, geojson, opacity, z)
+        if RENDER.MODE == 'raster':
+            # rasterized here, on the loader thread of the GUI, the rendering
+            # thread only stacks it
+            layer.texture = (layer.getOpacity(),) + self.rasterize(geojson, layer.getOpacity())
+        with self._lock:
+            layers = [l for l in self.layers if l.name != name] + [layer]
+            layers.sort(key=lambda l: l.z)
+            self.layers = layers
+
+    def hideLayer(self, name):
+        with self._lock:
+            self.layers = [l for l in self.layers if l.name != name]
+
+    def renderGeoJSON(self, static=False):
+        # a static frame gets the region composited on the last full frame
+        # pasted back when it had the same homography, returns whether it
+        # did; the full frame may have been dropped before it got here
+        layers = self.layers
+        key = (tuple(layers), self.H.tobytes(), self.highlighted, self.hovered, RENDER.MODE, RENDER.OPACITY)
+        if static and self.composited is not None and self.composited[0] == key:
+            _, roi = self.composited
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                self.frameImg[y0:y1, x0:x1] = self.buffers['composited'][y0:y1, x0:x1]
+            return True
+        if RENDER.MODE == 'raster':
+            roi = self.renderRaster(layers)
+        else:
+            roi = self.renderVector(layers)
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            composited = self.buffer('composited', self.frameImg.shape, np.uint8)
+            composited[y0:y1, x0:x1] = self.frameImg[y0:y1, x0:x1]
+        self.composited = (key, roi)
+        return False
+
+    def renderVector(self, layers):
+        # bottom to top, every layer blended on its own over the ones below
+        # like the raster stack; returns the region it touched
+        roi = None
+        for layer in layers:
+            roi = union(roi, self.renderLayer(layer))
+        return roi
+
+    def renderLayer(self, layer):
+        with PROFILER.stage('projection'):
+            pts, ids, parts = self.project(layer)
+        if not parts:
+            return None
+        # only the region the layer and its highlights can touch is composited
+        roi = self.region(pts)
+        if roi is None:
+            return None
+        x0, y0, x1, y1 = roi
+        overlayImg = self.buffer('overlay', self.frameImg.shape, np.uint8)
+        frameRoi = self.frameImg[y0:y1, x0:x1]
+        overlayRoi = overlayImg[y0:y1, x0:x1]
+        overlayRoi[:] = frameRoi
+        geojson = layer.geojson
+        with PROFILER.stage('overlay draw'):
+            for part in parts:
+                self.drawPart(overlayImg, pts, part)
+            for feature_uuid in self.highlights(layer):
+                start, end = geojson.featureRange(geojson.uuids[feature_uuid])
+                for part in parts[bisect_left(ids, start):bisect_left(ids, end)]:
+                    self.drawHighlight(self.frameImg, pts, part)
+        with PROFILER.stage('compositing'):
+            opacity = layer.getOpacity()
+            cv.addWeighted(overlayRoi, opacity, frameRoi, 1 - opacity, 0, frameRoi)
+        return roi
+
+    def project(self, layer):
+        # (pts, ids, parts) of the layer in the frame, the ones of the last
+        # frame again while the homography and the frame size are the same
+        key = (self.H.tobytes(), self.frameImg.shape)
+        if layer.projection is None or layer.projection[0] != key:
+            geojson = layer.geojson
+            level = geojson.level(self.scale())
+            visible = geojson.visible(self.viewport())
+            layer.projection = (key,) + geojson.project(self.H, level, visible)
+        return layer.projection[1:]
+
+    def region(self, pts):
+        # frame rectangle around the projected points grown by the widest
+        # stroke we draw (the highlight ring), None when it is out of view
+        h, w, _ = self.frameImg.shape
+        m = RENDER.POINT_RADIUS + 16
+        x0, y0 = pts.min(axis=0) - m
+        x1, y1 = pts.max(axis=0) + m + 1
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def buffer(self, name, shape, dtype):
+        # scratch images reused across frames, reallocated on size changes
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+        return buf
+
+    def renderRaster(self, layers):
+        # the textures of the layers are stacked in marker space once, every
+        # frame warps and blends a single texture however many layers; the
+        # highlights change with the pointer and are drawn over it instead
+        if not layers:
+            return None
+        key = tuple((layer, layer.getOpacity()) for layer in layers)
+        if self.texture is None or self.texture[0] != key:
+            with PROFILER.stage('overlay draw'):
+                self.texture = (key,) + self.stack(layers)
+        _, texture, extent = self.texture
+        m = RENDER.POINT_RADIUS + 16
+        x0, y0, x1, y1 = extent
+        roi = self.bounds((x0 - m, y0 - m, x1 + m, y1 + m))
+        if roi is None:
+            return None
+        x0, y0, x1, y1 = roi
+        s = RENDER.RASTER_SCALE
+        H = np.array([[1,0,-x0],[0,1,-y0],[0,0,1]]).dot(self.H).dot(np.diag([1/s, 1/s, 1]))
+        size = (x1 - x0, y1 - y0)
+        h, w, _ = self.frameImg.shape
+        warped = self.buffer('warped', (h, w, 4), np.uint8)[:y1 - y0, :x1 - x0]
+        warpedColor = self.buffer('color', (h, w, 3), np.uint8)[:y1 - y0, :x1 - x0]
+        coverage = self.buffer('coverage', (h, w), np.uint8)[:y1 - y0, :x1 - x0]
+        warpedAlpha = self.buffer('alpha', (h, w), np.float32)[:y1 - y0, :x1 - x0]
+        inverseAlpha = self.buffer('inverse', (h, w), np.float32)[:y1 - y0, :x1 - x0]
+        with PROFILER.stage('compositing'):
+            cv.warpPerspective(texture, H, size, warped)
+            cv.mixChannels([warped], [warpedColor, coverage], [0,0, 1,1, 2,2, 3,3])
+            cv.multiply(coverage, 1.0 / 255, warpedAlpha, dtype=cv.CV_32F)
+            cv.subtract(1.0, warpedAlpha, inverseAlpha)
+            frameImg = self.frameImg[y0:y1, x0:x1]
+            cv.blendLinear(warpedColor, frameImg, warpedAlpha, inverseAlpha, frameImg)
+        with PROFILER.stage('overlay draw'):
+            self.drawHighlights(layers)
+        return roi
+
+    def drawHighlights(self, layers):
+        # only the parts of the highlighted features are projected
+        for layer in layers:
+            geojson = layer.geojson
+            for feature_uuid in self.highlights(layer):
+                for kind, start, end, color, border in geojson.featureParts(geojson.uuids[feature_uuid]):
+                    pts = cv.perspectiveTransform(geojson.vertices[start:end].reshape(1, -1, 2), self.H)[0]
+                    self.drawHighlight(self.frameImg, pts.astype(np.int32), (kind, 0, end - start, color, border))
+
+    def stack(self, layers):
+        # RGBA texture and marker extent of the layers composited bottom to
+        # top, each layer rasterized again only when its opacity changed
+        textures = []
+        for layer in layers:
+            key = layer.getOpacity()
+            if layer.texture is None or layer.texture[0] != key:
+                layer.texture = (key,) + self.rasterize(layer.geojson, key)
+            textures.append(layer.texture[1:])
+        extent = None
+        for layer in layers:
+            x0, y0, x1, y1 = layer.geojson.extent
+            if x0 < x1 or y0 < y1:
+                extent = union(extent, (x0, y0, x1, y1))
+        extent = extent or (0, 0, 0, 0)
+        if len(textures) == 1:
+            color, alpha = textures[0]
+        else:
+            # the over operator on premultiplied colors
+            premultiplied = np.zeros(textures[0][0].shape, np.float32)
+            alpha = np.zeros(textures[0][1].shape, np.float32)
+            for color, a in textures:
+                premultiplied = color * a[..., None] + premultiplied * (1 - a[..., None])
+                alpha = a + alpha * (1 - a)
+            inside = alpha > 0
+            color = np.zeros(premultiplied.shape, np.uint8)
+            color[inside] = np.minimum(premultiplied[inside] / alpha[inside, None], 255)
+            self.bleed(color, inside)
+        # color and alpha in one texture so a frame warps it once
+        return np.dstack([color, np.round(alpha * 255).astype(np.uint8)]), extent
+
+    def highlights(self, layer):
+        # the highlighted and hovered features that belong to the layer
+        return tuple(sorted({ u for u in (self.highlighted, self.hovered) if u in layer.geojson.uuids }))
+
+    def rasterize(self, geojson, opacity):
+        # marker sized RGB texture with straight colors and a float alpha
+        s = RENDER.RASTER_SCALE
+        size = (int(self.h * s), int(self.w * s))
+        color = np.zeros(size + (3,), np.uint8)
+        cover = np.zeros(size, np.uint8)
+        pts, _, parts = geojson.project(np.diag([s, s, 1]))
+        white = (255,255,255)
+        for part in parts:
+            self.drawPart(color, pts, part)
+            self.drawPart(cover, pts, part[:3] + (white,) + part[4:])
+        # undo the antialiasing against the black background
+        inside = cover > 0
+        color[inside] = np.minimum(color[inside] * (255 / cover[inside, None]), 255)
+        self.bleed(color, inside)
+        alpha = (cover * opacity).astype(np.float32) / 255
+        return color, alpha
+
+    def bleed(self, color, inside):
+        # spread the colors outwards so bilinear warping does not darken
+        # the edges
+        bleed = cv.dilate(color, np.ones((3,3), np.uint8), iterations=2)
+        color[~inside] = bleed[~inside]
+
+    def bounds(self, rect):
+        # frame rectangle covered by a projected marker rectangle, whole frame
+        # when the marker plane horizon is in view and None when out of view
+        h, w, _ = self.frameImg.shape
+        x0, y0, x1, y1 = rect
+        pts = self.H.dot([[x0, x1, x1, x0], [y0, y0, y1, y1], [1, 1, 1, 1]])
+        if not (pts[2] > 0).all():
+            return 0, 0, w, h
+        x, y = pts[:2] / pts[2]
+        x0, y0 = max(int(x.min()), 0), max(int(y.min()), 0)
+        x1, y1 = min(int(np.ceil(x.max())) + 1, w), min(int(np.ceil(y.max())) + 1, h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def viewport(self):
+        # frame rectangle, grown by the widest stroke we draw, back projected
+        # to marker pixels; None when the marker plane horizon is in view
+        h, w, _ = self.frameImg.shape
+        m = RENDER.POINT_RADIUS + 16
+        pts = np.linalg.inv(self.H).dot([[-m, w + m, w + m, -m], [-m, -m, h + m, h + m], [1, 1, 1, 1]])
+        if not ((pts[2] > 0).all() or (pts[2] < 0).all()):
+            return None
+        x, y = pts[:2] / pts[2]
+        return x.min(), y.min(), x.max(), y.max()
+
+    def scale(self):
+        # screen pixels per marker pixel around the center of the marker
+        x, y = self.w / 2, self.h / 2
+        pts = np.float32([[[x,y],[x+1,y],[x,y+1]]])
+        pts = cv.perspectiveTransform(pts, self.H)[0]
+        return (np.linalg.norm(pts[1] - pts[0]) + np.linalg.norm(pts[2] - pts[0])) / 2
+
+    def drawPart(self, img, pts, part):
+        kind, start, end, color, border = part
+        if kind == GeoJSON.POINT:
+            cv.circle(img, tuple(pts[start].tolist()), RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
+        elif kind == GeoJSON.LINE:
+            cv.polylines(img, [pts[start:end]], False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)
+        elif kind == GeoJSON.POLYGON:
+            if border:
+                cv.polylines(img, [pts[start:end]], False, RENDER.POLYGON_BORDER_COLOR, RENDER.LINE_THICKNESS, cv.LINE_AA)
+            cv.fillPoly(img, [pts[start:end]], color, cv.LINE_AA)
+
+    def drawHighlight(self, img, pts, part):
+        kind, start, end, color, _ = part
+        if kind == GeoJSON.POINT:
+            center = tuple(pts[start].tolist())
+            cv.circle(img, center, RENDER.POINT_RADIUS, color, -1, cv.LINE_AA)
+            cv.circle(img, center, RENDER.POINT_RADIUS + 13, color, 3, cv.LINE_AA)
+        elif kind == GeoJSON.LINE:
+            cv.polylines(img, [pts[start:end]], False, color, RENDER.LINE_THICKNESS, cv.LINE_AA)
+        elif kind == GeoJSON.POLYGON:
+            cv.fillPoly(img, [pts[start:end]], color, cv.LINE_AA)
 
     def getClickedFeature(self, pos):
+        # the topmost layer with a feature there wins
         feature = None
-        if self.H is not None and self.geojson is not None:
-            pos = np.float32([[list(pos)]])
-            pos = cv.perspectiveTransform(pos, np.linalg.inv(self.H))[0][0]
-            pos = tuple(pos)
-            for f in self.geojson.features:
-                geo = f['geometry']
-                if geo['type'] == 'Point':
-                    ax, ay = tuple(geo['coordinates'])
-                    bx, by = pos
-                    xDiff = ax - bx
-                    yDiff = ay - by
-                    if math.sqrt((xDiff * xDiff) + (yDiff * yDiff)) < RENDER.POINT_RADIUS:
-                        feature = f
-                elif geo['type'] == 'Polygon':
-                    if cv.pointPolygonTest(np.int32(geo['coordinates'][0]), pos, False) == 1:
-                        feature = f
-                elif geo['type'] == 'MultiPolygon':
-                    for pts in geo['coordinates']:
-                        if cv.pointPolygonTest(np.int32(pts[0]), pos, False) == 1:
-                            feature = f
+        H, layers = self.H, self.layers
+        if H is not None and layers:
+            # the click and two neighbouring pixels give the marker/screen scale
+            x, y = pos
+            pts = np.float32([[[x,y],[x+1,y],[x,y+1]]])
+            pts = cv.perspectiveTransform(pts, np.linalg.inv(H))[0]
+            scale = (np.linalg.norm(pts[1] - pts[0]) + np.linalg.norm(pts[2] - pts[0])) / 2
+            for layer in reversed(layers):
+                feature = layer.geojson.featureAt(tuple(map(float, pts[0])),
+                    scale * (RENDER.POINT_RADIUS + RENDER.HIT_TOLERANCE),
+                    scale * (RENDER.LINE_THICKNESS / 2 + RENDER.HIT_TOLERANCE))
+                if feature is not None:
+                    break
         return feature
 
     def setHighlighted(self, feature_uuid):
         self.highlighted = feature_uuid
 
+    def setHovered(self, feature_uuid):
+        self.hovered = feature_uuid
+
+class Layer:
+    # a compiled layer in the stack of a Rendering and what was derived from
+    # it for the last frames; a new geojson makes a new Layer
+    def __init__(self, name, geojson, opacity=None, z=0):
+        self.name = name
+        self.geojson = geojson
+        self.opacity = opacity # RENDER.OPACITY when None
+        self.z = z
+        self.projection = None # frame key, pts, ids and parts
+        self.texture = None # opacity key, color and alpha
+
+    def getOpacity(self):
+        return RENDER.OPACITY if self.opacity is None else self.opacity
+
+def union(a, b):
+    # bounding rectangle of two (x0, y0, x1, y1), either may be None
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
 class GeoJSON:
+    # part kinds of the compiled geometry
+    POINT, LINE, POLYGON = 0, 1, 2
+    ORDER = ['Point','MultiPoint','LineString','MultiLineString','Polygon','MultiPolygon']
+    ARRAYS = ['vertices', 'offsets', 'kinds', 'owners', 'colors', 'borders', 'lodVertices', 'lodOffsets']
+    # Douglas-Peucker tolerances of the simplified levels, in marker pixels
+    LOD = [1, 2, 4, 8, 16]
+
     def __init__(self, features, coords2pixels):
         self.features = features
-        order = ['Point','MultiPoint','LineString','MultiLineString','Polygon','MultiPolygon']
-        self.features.sort(key=lambda x: order.index(x['geometry']['type']), reverse=True)
+        self.features.sort(key=lambda x: self.ORDER.index(x['geometry']['type']), reverse=True)
 
         src = np.array(coords2pixels['src'], np.float32)
         dst = np.array(coords2pixels['dst'], np.float32)
         M = cv.getAffineTransform(src,dst)
         M = np.append(M, [[0,0,1]], axis=0)
-        
-        for f in self.features:
-            geoType = f['geometry']['type']
-            f['uuid'] = str(uuid.uuid1())
-            if geoType == 'Point':
-                f['geometry']['coordinates'] = self.coords2pixels([f['geometry']['coordinates']], M)[0]
-            elif geoType == 'LineString':
-                f['geometry']['coordinates'] = self.coords2pixels(f['geometry']['coordinates'], M)
-            elif geoType == 'Polygon':
-                for i, coords in enumerate(f['geometry']['coordinates']):
-                    f['geometry']['coordinates'][i] = self.coords2pixels(coords, M)
-            elif geoType == 'MultiPolygon':
-                for i, coordsList in enumerate(f['geometry']['coordinates']):
-                    for j, coords in enumerate(coordsList):
-                        f['geometry']['coordinates'][i][j] = self.coords2pixels(coords, M)
+
+        # flatten every drawable part (point, line or polygon ring) into one
+        # vertex buffer indexed by offsets, one row per part in the tables
+        rings, kinds, owners, colors, borders = [], [], [], [], []
+        for i, f in enumerate(self.features):
+            # kept when the layer is compiled again from more features
+            f.setdefault('uuid', str(uuid.uuid1()))
+            props = f['properties']
+            geo = f['geometry']
+            color = ImageColor.getcolor(props['fill'], 'RGB') if 'fill' in props else None
+            border = False
+            if geo['type'] == 'Point':
+                kind, parts = self.POINT, [[geo['coordinates']]]
+                color = color or RENDER.POINT_COLOR
+            elif geo['type'] == 'MultiPoint':
+                kind, parts = self.POINT, [[pts] for pts in geo['coordinates']]
+                color = color or RENDER.LINE_COLOR
+            elif geo['type'] == 'LineString':
+                kind, parts = self.LINE, [geo['coordinates']]
+                color = color or RENDER.LINE_COLOR
+            elif geo['type'] == 'MultiLineString':
+                kind, parts = self.LINE, geo['coordinates']
+                color = color or RENDER.LINE_COLOR
+            elif geo['type'] == 'Polygon':
+                kind, parts = self.POLYGON, [geo['coordinates'][0]]
+                border = color is None
+                color = color or RENDER.POLYGON_COLOR
+            elif geo['type'] == 'MultiPolygon':
+                kind, parts = self.POLYGON, [pts[0] for pts in geo['coordinates']]
+                color = color or RENDER.POLYGON_COLOR
+                border = color == RENDER.POLYGON_COLOR
+            for pts in filter(len, parts):
+                rings.append(pts)
+                kinds.append(kind)
+                owners.append(i)
+                colors.append(color)
+                borders.append(border)
+
+        lengths = [len(pts) for pts in rings]
+        self.offsets = np.zeros(len(rings) + 1, np.int32)
+        self.offsets[1:] = np.cumsum(lengths)
+        self.kinds = np.uint8(kinds)
+        self.owners = np.int32(owners)
+        self.colors = np.uint8(colors).reshape(-1, 3)
+        self.borders = np.bool_(borders)
+        self.vertices = self.coords2pixels([c for pts in rings for c in pts], M)
+        self.simplify()
+        self.prepare()
+
+    @classmethod
+    def fromArrays(cls, features, arrays):
+        geojson = cls.__new__(cls)
+        geojson.features = features
+        for k in cls.ARRAYS:
+            setattr(geojson, k, arrays[k])
+        geojson.prepare()
+        return geojson
+
+    def arrays(self):
+        return { k: getattr(self, k) for k in self.ARRAYS }
+
+    def prepare(self):
+        # python side tables used by the per frame drawing loop
+        self.uuids = { f['uuid']: i for i, f in enumerate(self.features) }
+        self.featureOffsets = np.searchsorted(self.owners, np.arange(len(self.features) + 1)).tolist()
+        self.parts = list(zip(
+            self.kinds.tolist(),
+            self.offsets[:-1].tolist(),
+            self.offsets[1:].tolist(),
+            list(map(tuple, self.colors.tolist())),
+            self.borders.tolist()))
+        self.index = SpatialIndex(self.vertices, self.offsets)
+        self.extent = self.index.extent()
+        # level 0 is the full geometry, the others are slices of lodVertices
+        self.levels = [self.parts]
+        for offsets in self.lodOffsets:
+            offsets = (offsets - offsets[0]).tolist()
+            self.levels.append([(kind, start, end, color, border)
+                for (kind, _, _, color, border), start, end
+                in zip(self.parts, offsets[:-1], offsets[1:])])
+
+    def simplify(self):
+        # one Douglas-Peucker pass per level over every line and ring,
+        # points and degenerate parts are kept as they are
+        vertices = []
+        self.lodOffsets = np.zeros((len(self.LOD), len(self.kinds) + 1), np.int32)
+        total = 0
+        for l, epsilon in enumerate(self.LOD):
+            self.lodOffsets[l, 0] = total
+            for i, (kind, start, end) in enumerate(zip(self.kinds, self.offsets[:-1], self.offsets[1:])):
+                pts = self.vertices[start:end]
+                if kind != self.POINT and end - start > 3:
+                    pts = cv.approxPolyDP(pts, epsilon, False).reshape(-1, 2)
+                vertices.append(pts)
+                total += len(pts)
+                self.lodOffsets[l, i + 1] = total
+        self.lodVertices = np.concatenate(vertices) if vertices else np.zeros((0, 2), np.float32)
+
+    def level(self, scale):
+        # coarsest level whose simplification error stays under the tolerance
+        level = 0
+        for l, epsilon in enumerate(self.LOD):
+            if epsilon * scale <= RENDER.LOD_TOLERANCE:
+                level = l + 1
+        return level
+
+    def featureAt(self, pos, pointRadius, lineWidth):
+        # candidates come topmost first, i.e. in reverse drawing order
+        for i in self.index.query(pos, max(pointRadius, lineWidth)):
+            kind, start, end, _, _ = self.parts[i]
+            pts = self.vertices[start:end]
+            if kind == self.POINT:
+                hit = np.hypot(*(pts[0] - pos)) <= pointRadius
+            elif kind == self.LINE:
+                hit = self.distance(pts, pos) <= lineWidth
+            else:
+                hit = cv.pointPolygonTest(pts, pos, False) >= 0
+            if hit:
+                return self.features[self.owners[i]]
+        return None
+
+    def distance(self, pts, pos):
+        # distance from pos to the closest segment of a polyline
+        if len(pts) == 1:
+            return np.hypot(*(pts[0] - pos))
+        a, ab = pts[:-1], np.diff(pts, axis=0)
+        t = np.clip(((pos - a) * ab).sum(axis=1) / np.maximum((ab * ab).sum(axis=1), 1e-12), 0, 1)
+        return np.hypot(*(a + ab * t[:, None] - pos).T).min()
+
+    def featureRange(self, i):
+        return self.featureOffsets[i], self.featureOffsets[i + 1]
+
+    def featureParts(self, i, level=0):
+        return self.levels[level][self.featureOffsets[i]:self.featureOffsets[i + 1]]
+
+    def visible(self, rect):
+        if rect is None:
+            return None
+        x0, y0, x1, y1 = rect
+        b = self.index.bboxes
+        return (b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)
+
+    def project(self, H, level=0, visible=None):
+        # one batched homography for the whole layer, truncated to pixels,
+        # parts outside the visible mask are dropped before projecting
+        parts = self.levels[level]
+        ids = range(len(parts))
+        if level == 0:
+            vertices, offsets = self.vertices, self.offsets
+        else:
+            offsets = self.lodOffsets[level - 1]
+            vertices = self.lodVertices[offsets[0]:offsets[-1]]
+        if visible is not None and not visible.all():
+            lengths = np.diff(offsets)
+            vertices = vertices[np.repeat(visible, lengths)]
+            ids = np.flatnonzero(visible).tolist()
+            ends = np.cumsum(lengths[visible]).tolist()
+            parts = [(kind, end - (e - s), end, color, border)
+                for (kind, s, e, color, border), end in zip(map(parts.__getitem__, ids), ends)]
+        if not len(vertices):
+            return np.zeros((0, 2), np.int32), ids, parts
+        pts = cv.perspectiveTransform(vertices.reshape(1, -1, 2), H)[0]
+        return pts.astype(np.int32), ids, parts
 
     def coords2pixels(self, coords, M):
         # switch lat long and perspectiveTransform
-        coords = np.transpose(coords)
-        coords = [coords[1], coords[0]]
-        coords = np.transpose(coords)
-        coords = cv.perspectiveTransform(np.float32([coords]), M)[0]
-        return coords.tolist()
+        if not len(coords):
+            return np.zeros((0, 2), np.float32)
+        coords = np.float32([c[:2] for c in coords])[:, ::-1]
+        coords = cv.perspectiveTransform(np.ascontiguousarray(coords).reshape(1, -1, 2), M)[0]
+        return coords
+
+class SpatialIndex:
+    # uniform grid over the part bounding boxes, in marker pixels
+    MAX_CELLS = 256
+
+    def __init__(self, vertices, offsets):
+        n = len(offsets) - 1
+        self.bboxes = np.zeros((n, 4), np.float32)
+        self.origin = np.zeros(2, np.float32)
+        self.size = 1.0
+        self.shape = (1, 1)
+        self.cellStart = np.zeros(2, np.int64)
+        self.cellParts = np.zeros(0, np.int64)
+        if not n:
+            return
+        starts = np.asarray(offsets[:-1])
+        self.bboxes[:, :2] = np.minimum.reduceat(vertices, starts)
+        self.bboxes[:, 2:] = np.maximum.reduceat(vertices, starts)
+
+        self.origin = self.bboxes[:, :2].min(axis=0)
+        extent = self.bboxes[:, 2:].max(axis=0) - self.origin
+        cells = max(1, min(self.MAX_CELLS, int(np.sqrt(n))))
+        self.size = max(float(extent.max()) / cells, 1.0)
+        nx, ny = (extent // self.size).astype(np.int64) + 1
+        self.shape = (nx, ny)
+
+        # register every part in all the cells its bounding box touches
+        lo = self.cell(self.bboxes[:, :2])
+        hi = self.cell(self.bboxes[:, 2:])
+        span = hi - lo + 1
+        counts = span[:, 0] * span[:, 1]
+        parts = np.repeat(np.arange(n), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = lo[parts, 0] + local % span[parts, 0]
+        cy = lo[parts, 1] + local // span[parts, 0]
+        cells = cy * nx + cx
+        order = np.argsort(cells, kind='stable')
+        self.cellParts = parts[order]
+        self.cellStart = np.zeros(nx * ny + 1, np.int64)
+        self.cellStart[1:] = np.cumsum(np.bincount(cells, minlength=nx * ny))
+
+    def extent(self):
+        if not len(self.bboxes):
+            return 0, 0, 0, 0
+        x0, y0 = self.bboxes[:, :2].min(axis=0).tolist()
+        x1, y1 = self.bboxes[:, 2:].max(axis=0).tolist()
+        return x0, y0, x1, y1
+
+    def cell(self, pts):
+        cells = ((np.asarray(pts) - self.origin) // self.size).astype(np.int64)
+        return np.clip(cells, 0, np.array(self.shape) - 1)
+
+    def query(self, pos, pad=0):
+        x, y = pos
+        (x0, y0), (x1, y1) = self.cell([[x - pad, y - pad], [x + pad, y + pad]])
+        nx = self.shape[0]
+        ids = [self.cellParts[self.cellStart[c]:self.cellStart[c + 1]]
+            for cy in range(y0, y1 + 1) for c in range(cy * nx + x0, cy * nx + x1 + 1)]
+        ids = np.unique(np.concatenate(ids))
+        b = self.bboxes[ids]
+        ids = ids[(b[:, 0] - pad <= x) & (b[:, 2] + pad >= x) & (b[:, 1] - pad <= y) & (b[:, 3] + pad >= y)]
+        return ids[::-1].tolist()
@@ -0,0 +1,185 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Service
+# *****************************************************************************
+
+import os
+import re
+import glob
+import json
+import time
+import yaml
+import shutil
+import argparse
+import tempfile
+import cv2 as cv
+import numpy as np
+from multiprocessing import Pool
+
+from camera import open_source, Recorder
+from config import VIDEO
+from tracking import Tracking, MarkerPyramid
+from rendering import Rendering
+from layercache import LayerCache
+from targets import load_targets
+
+# the targets and the tracking of a worker process, set up once by attach
+_targets = []
+_tracking = None
+
+class SharedData:
+    # the target images, marker pyramids and compiled layers written once
+    # as .npy files on shared memory (/dev/shm when there is one), every
+    # worker maps them read-only instead of computing them again
+    def __init__(self, path, config, layers=()):
+        self.root = tempfile.mkdtemp(prefix='ar4maps-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.manifest = []
+        try:
+            for i, target in enumerate(load_targets(path, config)):
+                root = os.path.join(self.root, str(i))
+                self.write(root, 'img', target.img)
+                for k, array in target.marker.arrays().items():
+                    self.write(root, k, array)
+                cache = LayerCache(target.coords)
+                shown = []
+                for z, layer in enumerate(target.layers):
+                    if layer['name'] in layers:
+                        name = 'layer%d' % z
+                        cache.write(cache.load(path + layer['file']), root, name, os.path.join(root, name))
+                        shown.append((layer['name'], name, layer.get('opacity'), layer.get('z', z)))
+                self.manifest.append({ 'name': target.name, 'coords': target.coords, 'root': root, 'layers': shown })
+        except BaseException:
+            self.close()
+            raise
+
+    def write(self, root, name, array):
+        os.makedirs(root, exist_ok=True)
+        np.save(os.path.join(root, name + '.npy'), np.ascontiguousarray(array))
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def attach(manifest):
+    # worker initializer, one thread per worker so they scale with cores
+    global _tracking
+    cv.setNumThreads(1)
+    read = lambda root, k: np.load(os.path.join(root, k + '.npy'), mmap_mode='r')
+    for target in manifest:
+        root = target['root']
+        marker = MarkerPyramid.fromArrays({ k: read(root, k) for k in MarkerPyramid.ARRAYS })
+        cache = LayerCache(target['coords'])
+        layers = [(name, cache.read(os.path.join(root, dirname)), opacity, z)
+            for name, dirname, opacity, z in target['layers']]
+        _targets.append((target['name'], read(root, 'img'), target['coords'], marker, layers))
+    # the FLANN index is built once per worker, every stream resets the rest
+    _tracking = Tracking([t[3] for t in _targets], asynchronous=False)
+    _tracking.index.prepare()
+
+def annotate(task):
+    # tracks and renders every frame of one stream, written to output when
+    # there is one; runs in a worker
+    source, output, limit = task
+    tracking = _tracking
+    tracking.reset()
+    renderings = []
+    for name, img, coords, marker, layers in _targets:
+        rendering = Rendering(img, coords)
+        for layer in layers:
+            rendering.showLayer(*layer)
+        renderings.append(rendering)
+    stream = open_source(source)
+    recorder = Recorder(output, stream.get(cv.CAP_PROP_FPS) or VIDEO.FPS) if output is not None else None
+    start, cpu = time.perf_counter(), time.process_time()
+    frames, tracked = 0, 0
+    captured, frameImg = None, None
+    while limit is None or frames < limit:
+        flag, captured = stream.read(captured)
+        if not flag:
+            break
+        frameImg = cv.cvtColor(captured, cv.COLOR_BGR2RGB, frameImg if frameImg is not None and frameImg.shape == captured.shape else None)
+        H = tracking.update(frameImg)
+        if H is not None:
+            tracked += 1
+            rendering = renderings[tracking.target]
+            rendering.update(H, frameImg)
+            rendering.renderGeoJSON(tracking.static)
+        if recorder is not None:
+            recorder.write(cv.cvtColor(frameImg, cv.COLOR_RGB2BGR, captured))
+        frames += 1
+    stream.release()
+    if recorder is not None:
+        recorder.release()
+    return {
+        'source': source,
+        'output': output,
+        'frames': frames,
+        'tracked': tracked / max(frames, 1),
+        'seconds': time.perf_counter() - start,
+        'cpu': time.process_time() - cpu,
+    }
+
+def run(shared, sources, workers, output=None, limit=None):
+    # every stream on a pool of workers; throughput is frames over the wall
+    # time of the whole run, per core over the cores the workers could use
+    tasks = []
+    for i, source in enumerate(sources):
+        name = '{:02d}-{}.avi'.format(i, stream_name(source))
+        tasks.append((source, os.path.join(output, name) if output is not None else None, limit))
+    start = time.perf_counter()
+    with Pool(workers, attach, (shared.manifest,)) as pool:
+        streams = list(pool.imap(annotate, tasks))
+    seconds = time.perf_counter() - start
+    frames = sum(s['frames'] for s in streams)
+    cores = min(workers, os.cpu_count() or 1, len(tasks))
+    return {
+        'workers': workers,
+        'streams': streams,
+        'frames': frames,
+        'seconds': seconds,
+        'fps': frames / seconds,
+        'fps_per_core': frames / seconds / cores,
+        'cpu': sum(s['cpu'] for s in streams),
+    }
+
+def stream_name(source):
+    # file name of a video, directory name of images
+    source = str(source)
+    if glob.has_magic(source):
+        source = os.path.dirname(source)
+    name = os.path.splitext(os.path.basename(source.rstrip('/\\')))[0]
+    return re.sub(r'[^\w.-]+', '_', name) or 'stream'
+
+def source_arg(source):
+    # webcam indexes are numbers
+    return int(source) if source.isdigit() else source
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='data directory with config.yml')
+    parser.add_argument('sources', nargs='+', type=source_arg, help='video files, image directories or globs, webcam indexes or stream urls')
+    parser.add_argument('--layer', action='append', default=[], help='name of a layer to render on every target that has it, none by default, repeat for more')
+    parser.add_argument('--workers', type=int, action='append', help='worker processes, repeat to measure how throughput scales, the CPU count by default')
+    parser.add_argument('--output', help='directory for the annotated videos, none are written by default')
+    parser.add_argument('--frames', type=int, help='stop every stream after this many frames, needed for live ones')
+    parser.add_argument('--report', help='JSON file for the report')
+    args = parser.parse_args()
+
+    with open(args.path + 'config.yml') as f:
+        config = yaml.safe_load(f)
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    shared = SharedData(args.path, config, args.layer)
+    try:
+        results = []
+        for workers in args.workers or [os.cpu_count() or 1]:
+            result = run(shared, args.sources, workers, args.output, args.frames)
+            results.append(result)
+            print("\033[0;30;102m[INFO]\033[0m {} workers, {} streams, {} frames in {:.2f} s, {:.1f} FPS, {:.1f} FPS per core".format(
+                workers, len(result['streams']), result['frames'], result['seconds'], result['fps'], result['fps_per_core']))
+    finally:
+        shared.close()
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,29 @@
+# *****************************************************************************
+# * Author: Miguel Magalhaes
+# * Email: miguel@magalhaes.pro
+# *****************************************************************************
+# * Targets
+# *****************************************************************************
+
+import cv2 as cv
+
+from markercache import MarkerCache
+
+class Target:
+    def __init__(self, path, config):
+        self.name = config.get('name', config.get('title', config['target']))
+        self.file = path + config['target']
+        self.detail = path + config['detail'] if 'detail' in config else None
+        self.coords = config['coords']
+        self.layers = config.get('layers', [])
+        self.img = cv.imread(self.file)
+        self.marker = None
+
+def load_targets(path, config):
+    # a config without a targets list is a single map, its target, coords
+    # and layers are at the top level
+    targets = [Target(path, c) for c in config.get('targets', [config])]
+    cache = MarkerCache()
+    for target in targets:
+        target.marker = cache.load(target.file, target.detail)
+    return targets
@@ -5,12 +5,25 @@
 # * Tracking
 # *****************************************************************************
 
+import time
 import cv2 as cv
 import numpy as np
-import copy
+from concurrent.futures import ThreadPoolExecutor
+
+from profiler import PROFILER
 
 class Tracking:
     LOWES_RATIO = 0.7
+    # the region searched first after losing track is the last marker quad
+    # moved along its last velocity and grown by a fraction of its size,
+    # more for every frame lost, for at most ROI_FRAMES frames
+    ROI_MARGIN = 0.25
+    ROI_GROWTH = 0.05
+    ROI_FRAMES = 60
+    # ORB runs on a downscaled region as long as the marker stays this big
+    DOWNSCALE_MIN_SCALE = 0.35
+    # pixels per downscale the refined corners may move the coarse ones
+    REFINE_MAX_SHIFT = 4
 
     min_matches = 50
     index_params = dict(
@@ -19,86 +32,630 @@ class Tracking:
         key_size = 10,
         multi_probe_level = 1)
     search_params = dict(checks=50)
-    flann = cv.FlannBasedMatcher(
-        index_params,
-        search_params)
     lk_params = dict(
         winSize  = (8,8),
         maxLevel = 8,
         criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.01))
+    refine_params = dict(
+        winSize  = (15,15),
+        maxLevel = 2,
+        criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.01))
 
-    def __init__(self, markerImg):
-        self.marker = FeatureExtraction(markerImg)
-        self.marker.detect_and_compute()
-        self.prev_frame = None
+    def __init__(self, markers, asynchronous=True):
+        # one MarkerPyramid per target, usually loaded from the MarkerCache
+        self.markers = markers
+        self.index = MarkerIndex(markers)
+        self._grays = [] # gray images of the frames, reused
+        # relocalization runs on a worker so ORB never stalls the caller
+        self._executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.reset()
+
+    def reset(self):
+        # forgets the frames so far to track a new stream, the index and the
+        # buffers are kept
+        self.target = 0 # the tracked target, or the last one
+        self.scale = 1
+        self.quad = None # last tracked marker corners
+        self.velocity = np.zeros(2, np.float32)
+        self.lost = 0
         self.frame = None
         self._numFrames = 0
         self.H = None
+        self.static = False # whether the last frame reused the homography
+        self._job = None
+        # synchronous tracking waits for every attempt, no budget to keep
+        self.scheduler = RelocalizationScheduler(budget=self._executor is not None)
+        self.points = PointTracker()
+        self.still = StaticScene()
     
     def update(self, frameImg):
         self._numFrames += 1
-        self.marker.matched_pts = []
-        self.prev_frame = copy.copy(self.frame)
-        self.frame = FeatureExtraction(frameImg)
+        self.frame = FeatureExtraction(frameImg, self.gray_buffer(frameImg.shape[:2]))
+        self.scheduler.update(self.frame.gray_img)
+
+        # nothing moved since the last tracked frame, its homography holds
+        self.static = self.H is not None and self.still.check(self.scheduler.thumb)
+        if(self.static):
+            return self.H
 
         if(self.H is not None):
-            self.optical_flow()
-            if(len(self.frame.matched_pts) > self.min_matches * 25):
-                self.H = self.pose_estimation(self.prev_frame, self.frame).dot(self.H)
+            with PROFILER.stage('optical flow'):
+                self.H = self.points.track(self.frame.gray_img, self.lk_params)
+            if(self.H is not None):
+                with PROFILER.stage('top up'):
+                    self.points.top_up(self.frame.gray_img, self.H)
             else:
-                self.H = None
-        
-        if(self.H is None and self._numFrames % 10 == 0):
-            self.H = None
-            self.frame.detect_and_compute()
-            self.feature_matching()
-            if(len(self.marker.matched_pts) > self.min_matches):
-                self.H = self.pose_estimation(self.marker, self.frame)
+                self.scheduler.lost()
         
+        if(self.H is None):
+            if(self._job is not None):
+                self.H = self.fast_forward()
+            elif(self.scheduler.due()):
+                self.scheduler.start()
+                roi = self.predict_roi()
+                if(self._executor is None):
+                    self.target, self.H = self.relocalize(self.frame, roi)
+                    self.scheduler.finish(self.H is not None)
+                else:
+                    future = self._executor.submit(self.relocalize, self.frame, roi)
+                    self._job = Relocalization(future, self.frame)
+            if(self.H is not None):
+                self.points.reset(self.frame.gray_img, self.H, self.markers[self.target].size)
+
+        if(self.H is not None):
+            self.scale = self.marker_scale(self.H)
+            self.update_motion()
+            self.still.anchor(self.scheduler.thumb)
+        else:
+            self.lost += 1
         return self.H
 
-    def feature_matching(self):
+    def gray_buffer(self, shape):
+        # a gray image no one needs anymore; the previous frame is still the
+        # one LK tracks a relocalization from and the snapshot it runs on
+        # must live until it is done
+        used = []
+        if(self.frame is not None):
+            used.append(self.frame.gray_img)
+        if(self._job is not None):
+            used.append(self._job.frame.gray_img)
+        self._grays = [g for g in self._grays if g.shape == shape]
+        for gray in self._grays:
+            if(not any(gray is u for u in used)):
+                return gray
+        gray = np.empty(shape, np.uint8)
+        self._grays.append(gray)
+        return gray
+
+    def update_motion(self):
+        w, h = self.markers[self.target].size
+        quad = cv.perspectiveTransform(np.float32([[[0,0],[w,0],[w,h],[0,h]]]), self.H)[0]
+        if(self.quad is not None and not self.lost):
+            self.velocity = 0.5 * self.velocity + 0.5 * (quad - self.quad).mean(0)
+        else:
+            self.velocity[:] = 0
+        self.quad = quad
+        self.lost = 0
+
+    def predict_roi(self):
+        # (x0, y0, x1, y1) where the marker should be, None without a guess
+        if(self.quad is None or self.lost > self.ROI_FRAMES):
+            return None
+        quad = self.quad + self.velocity * self.lost
+        x0, y0 = quad.min(0)
+        x1, y1 = quad.max(0)
+        margin = max(x1 - x0, y1 - y0) * (self.ROI_MARGIN + self.ROI_GROWTH * self.lost)
+        height, width = self.frame.gray_img.shape
+        x0, y0 = max(int(x0 - margin), 0), max(int(y0 - margin), 0)
+        x1, y1 = min(int(x1 + margin), width), min(int(y1 + margin), height)
+        if(x1 - x0 < 32 or y1 - y0 < 32):
+            return None
+        return x0, y0, x1, y1
+
+    def relocalize(self, frame, roi=None):
+        # returns the recognized target and its homography, the last target
+        # and None when nothing was recognized; the predicted region first,
+        # on a downscaled image when the marker is big enough for it
+        start = time.perf_counter()
+        try:
+            if(roi is not None):
+                downscale = 2 if self.scale / 2 >= self.DOWNSCALE_MIN_SCALE else 1
+                height, width = frame.gray_img.shape
+                if(downscale > 1 or roi != (0, 0, width, height)):
+                    target, H = self.search(frame, roi, downscale)
+                    if(H is not None):
+                        return target, H
+            return self.search(frame)
+        finally:
+            self.scheduler.record(time.perf_counter() - start)
+
+    def search(self, frame, roi=None, downscale=1):
+        with PROFILER.stage('orb detect'):
+            frame.detect_and_compute(roi, downscale)
+        # the pyramid level closest to the last known distance first, blurry
+        # frames often only match the coarser ones
+        for level in self.index.levels(self.scale / downscale):
+            with PROFILER.stage('matching'):
+                matches = self.feature_matching(frame, level)
+            for target, marker_pts, frame_pts in matches:
+                with PROFILER.stage('homography'):
+                    H, mask = cv.findHomography(marker_pts, frame_pts, cv.RANSAC, 5.0 * downscale)
+                    if(H is not None and downscale > 1):
+                        H = self.refine(frame, target, H, downscale)
+                if(H is not None):
+                    return target, H
+        return self.target, None
+
+    def refine(self, frame, target, H, downscale):
+        # the marker warped by the coarse homography is a close enough view
+        # for LK to move its corners to where they are at full resolution
+        marker = self.markers[target]
+        height, width = frame.gray_img.shape
+        warped = cv.warpPerspective(marker.gray, H, (width, height))
+        pts = cv.perspectiveTransform(marker.corners, H)
+        refined, st, err = cv.calcOpticalFlowPyrLK(warped, frame.gray_img, pts, None, **self.refine_params)
+        st = st.ravel() == 1
+        if(st.sum() <= self.min_matches):
+            return None
+        R, mask = cv.findHomography(marker.corners[st], refined[st], cv.RANSAC, 3.0)
+        # LK only corrects the coarse estimate, anything else is a failure
+        if(R is None or mask.sum() <= self.min_matches):
+            return None
+        w, h = marker.size
+        quad = np.float32([[[0,0],[w,0],[w,h],[0,h]]])
+        if(np.abs(cv.perspectiveTransform(quad, R) - cv.perspectiveTransform(quad, H)).max() > self.REFINE_MAX_SHIFT * downscale):
+            return None
+        return R
+
+    def fast_forward(self):
+        # follow the snapshot into the current frame and, once the worker is
+        # done, chain its homography with the motion tracked in the meantime
+        job = self._job
+        with PROFILER.stage('optical flow'):
+            job.track(self.frame, self.lk_params)
+        if(not job.future.done()):
+            return None
+        self._job = None
+        self.target, H = job.future.result()
+        F = job.motion() if H is not None else None
+        self.scheduler.finish(F is not None)
+        if(F is None):
+            return None
+        return F.dot(H)
+
+    def feature_matching(self, frame, level):
+        # every good match votes for the target of its marker descriptor;
+        # returns (target, marker points, frame points) for the targets with
+        # enough votes, the most voted first
+        if(frame.des is None or len(frame.des) <= 2):
+            return []
+        matcher, pts, owners = self.index.level(level)
         matches = [] # good matches as per Lowe's ratio test
-        if(self.frame.des is not None and len(self.frame.des) > 2):
-            all_matches = self.flann.knnMatch(self.marker.des, self.frame.des, k=2)
-            try:
-                for m,n in all_matches:
-                    if m.distance < self.LOWES_RATIO * n.distance:
-                        matches.append(m)
-            except ValueError:
-                pass
-            if(len(matches) > self.min_matches):    
-                self.marker.matched_pts = np.float32([ self.marker.kps[m.queryIdx].pt for m in matches ]).reshape(-1,1,2)
-                self.frame.matched_pts = np.float32([ self.frame.kps[m.trainIdx].pt for m in matches ]).reshape(-1,1,2)
-
-    def optical_flow(self):
-        if(not len(self.prev_frame.pts)):
-            self.prev_frame.convert_kps()
-        self.frame.pts, st, err = cv.calcOpticalFlowPyrLK(self.prev_frame.gray_img, self.frame.gray_img, self.prev_frame.pts, None, **self.lk_params)
-        st = list(np.concatenate(st)) # flatten list
-        self.prev_frame.matched_pts = np.float32([ self.prev_frame.pts[i] for i in range(len(st)) if st[i] == 1 ]).reshape(-1,1,2)
-        self.frame.matched_pts = np.float32([ self.frame.pts[i] for i in range(len(st)) if st[i] == 1 ]).reshape(-1,1,2)
-
-    def pose_estimation(self, src, dst):
-        H, _ = cv.findHomography(src.matched_pts, dst.matched_pts, cv.RANSAC, 5.0)
+        for pair in matcher.knnMatch(frame.des, k=2):
+            if len(pair) == 2 and pair[0].distance < self.LOWES_RATIO * pair[1].distance:
+                matches.append(pair[0])
+        if(len(matches) <= self.min_matches):
+            return []
+        marker_idx = np.int32([ m.trainIdx for m in matches ])
+        frame_pts = np.float32([ frame.kps[m.queryIdx].pt for m in matches ]).reshape(-1,1,2)
+        votes = np.bincount(owners[marker_idx], minlength=len(self.markers))
+        candidates = []
+        for target in np.argsort(-votes, kind='stable'):
+            if(votes[target] <= self.min_matches):
+                break
+            voted = owners[marker_idx] == target
+            candidates.append((int(target), pts[marker_idx[voted]].reshape(-1,1,2), frame_pts[voted]))
+        return candidates
+
+    def marker_scale(self, H):
+        # frame pixels per marker pixel around the center of the marker
+        w, h = self.markers[self.target].size
+        x, y = w / 2, h / 2
+        pts = cv.perspectiveTransform(np.float32([[[x,y],[x+1,y],[x,y+1]]]), H)[0]
+        return (np.linalg.norm(pts[1] - pts[0]) + np.linalg.norm(pts[2] - pts[0])) / 2
+
+    def stop(self):
+        if(self._executor is not None):
+            self._executor.shutdown(wait=False)
+
+class RelocalizationScheduler:
+    # picks the lost frames to relocalize on: right after losing the marker,
+    # then less and less often while attempts fail, sooner again once the
+    # view changed since the last failure, not while the camera moves fast
+    # and never more often than the CPU budget allows
+    MAX_INTERVAL = 32 # frames
+    CHANGE = 8 # mean absolute difference of the thumbnails, out of 255
+    MOTION = 16
+    BUDGET = 0.5 # fraction of the frame time relocalization may take
+    THUMBNAIL = (64, 36)
+
+    def __init__(self, budget=True):
+        # without a budget the schedule only depends on the frames, runs
+        # repeat whatever the speed of the machine
+        self.budgeted = budget
+        self.attempts = 0
+        self.successes = 0
+        self.time = 0.0 # seconds spent relocalizing
+        self.interval = 1
+        self.motion = 0
+        self._wait = 0
+        self.thumb = None
+        self._failed = None # thumbnail of the last failed attempt
+        self._attempt = None
+        self._cost = None # average seconds per attempt
+        self._period = None # average seconds between frames
+        self._last = None
+
+    def update(self, gray_img):
+        # every frame, tracked or lost
+        if(self.budgeted):
+            now = time.perf_counter()
+            if(self._last is not None):
+                period = now - self._last
+                self._period = period if self._period is None else 0.9 * self._period + 0.1 * period
+            self._last = now
+        thumb = cv.resize(gray_img, self.THUMBNAIL, interpolation=cv.INTER_AREA)
+        self.motion = self.difference(thumb, self.thumb)
+        self.thumb = thumb
+        self._wait -= 1
+
+    def difference(self, a, b):
+        return cv.norm(a, b, cv.NORM_L1) / a.size if b is not None else 0
+
+    def lost(self):
+        self.interval = 1
+        self._wait = 0
+        self._failed = None
+
+    def due(self):
+        # whether to relocalize on the current lost frame
+        if(self._failed is not None and self.difference(self.thumb, self._failed) > self.CHANGE):
+            # something else in view, worth trying again soon
+            self._failed = None
+            self.interval = 1
+            self._wait = min(self._wait, self.budget())
+        if(self._wait > 0):
+            return False
+        # let the camera settle for sharper frames, but not forever
+        if(self.motion > self.MOTION and self._wait > -self.MAX_INTERVAL):
+            return False
+        return True
+
+    def budget(self):
+        # fewest frames between attempts that keeps within the budget
+        if(self._cost is None or not self._period):
+            return 0
+        return int(self._cost / (self.BUDGET * self._period))
+
+    def start(self):
+        self.attempts += 1
+        self._attempt = self.thumb
+
+    def record(self, duration):
+        # may be called from the relocalization worker
+        self.time += duration
+        self._cost = duration if self._cost is None else 0.7 * self._cost + 0.3 * duration
+
+    def finish(self, success):
+        if(success):
+            self.successes += 1
+            self.interval = 1
+            self._failed = None
+        else:
+            self.interval = min(2 * self.interval, self.MAX_INTERVAL)
+            self._failed = self._attempt
+        self._wait = max(self.interval, self.budget())
+
+class StaticScene:
+    # a frame is static when its thumbnail is close to the one of the last
+    # frame tracked in full, closer than half a pixel of motion makes it
+    THRESHOLD = 0.45 # mean absolute difference of the thumbnails, out of 255
+    MAX_FRAMES = 150 # static frames in a row before tracking in full anyway
+
+    def __init__(self):
+        self.frames = 0 # static frames so far
+        self._reference = None
+        self._count = 0
+
+    def check(self, thumb):
+        if(self._reference is None or self._count >= self.MAX_FRAMES):
+            return False
+        if(cv.norm(thumb, self._reference, cv.NORM_L1) / thumb.size > self.THRESHOLD):
+            return False
+        self._count += 1
+        self.frames += 1
+        return True
+
+    def anchor(self, thumb):
+        self._reference = thumb
+        self._count = 0
+
+class PointTracker:
+    # a bounded set of corners tracked with LK, each anchored to its marker
+    # position so the homography is fitted to the marker and doesn't drift;
+    # a GRID over the marker keeps them spread out and cells that lost
+    # their points are topped up with new corners inside the marker quad
+    BUDGET = 400
+    GRID = (8, 6)
+    FB_THRESHOLD = 1.0 # pixels between a point and its forward-backward track
+    TOP_UP = 0.8 # fraction of the points left since the last top up
+    feature_params = dict(
+        qualityLevel = 0.01,
+        minDistance = 8,
+        blockSize = 7)
+
+    def __init__(self):
+        self.pts = np.zeros((0,1,2), np.float32)
+        self.marker_pts = np.zeros((0,1,2), np.float32)
+        self.size = (1, 1)
+        self.prev_img = None
+        self._spare = None # the equalized image before prev_img, reused
+        self.full = 0
+
+    def reset(self, gray_img, H, size):
+        self.pts = np.zeros((0,1,2), np.float32)
+        self.marker_pts = np.zeros((0,1,2), np.float32)
+        self.size = size
+        self.full = self.BUDGET
+        self.prev_img = self.equalize(gray_img)
+        self.top_up(gray_img, H)
+
+    def equalize(self, gray_img):
+        spare, self._spare = self._spare, self.prev_img
+        if(spare is None or spare.shape != gray_img.shape):
+            return cv.equalizeHist(gray_img)
+        return cv.equalizeHist(gray_img, spare)
+
+    def track(self, gray_img, lk_params):
+        # returns the homography from the marker to gray_img, None when lost;
+        # LK runs on equalized images so lighting changes don't break it
+        prev_img, img = self.prev_img, self.equalize(gray_img)
+        self.prev_img = img
+        if(len(self.pts) < Tracking.min_matches):
+            return None
+        pts, st, err = cv.calcOpticalFlowPyrLK(prev_img, img, self.pts, None, **lk_params)
+        back, st_back, err = cv.calcOpticalFlowPyrLK(img, prev_img, pts, None, **lk_params)
+        good = (st.ravel() == 1) & (st_back.ravel() == 1) & (np.abs(back - self.pts).reshape(-1,2).max(1) < self.FB_THRESHOLD)
+        self.pts, self.marker_pts = pts[good], self.marker_pts[good]
+        if(len(self.pts) < Tracking.min_matches):
+            return None
+        with PROFILER.stage('homography'):
+            H, mask = cv.findHomography(self.marker_pts, self.pts, cv.RANSAC, 3.0)
+        if(H is None):
+            return None
+        inliers = mask.ravel() == 1
+        self.pts, self.marker_pts = self.pts[inliers], self.marker_pts[inliers]
+        if(len(self.pts) < Tracking.min_matches):
+            return None
         return H
 
+    def cells(self, marker_pts):
+        gx, gy = self.GRID
+        w, h = self.size
+        x = np.clip((marker_pts[:,0,0] * gx / w).astype(np.int32), 0, gx - 1)
+        y = np.clip((marker_pts[:,0,1] * gy / h).astype(np.int32), 0, gy - 1)
+        return y * gx + x
+
+    def top_up(self, gray_img, H):
+        # only once enough points were lost, the marker may not have corners
+        # for the whole budget
+        if(len(self.pts) >= self.TOP_UP * min(self.full, self.BUDGET)):
+            return
+        # corners inside the marker quad, away from the tracked points
+        w, h = self.size
+        quad = cv.perspectiveTransform(np.float32([[[0,0],[w,0],[w,h],[0,h]]]), H)[0]
+        height, width = gray_img.shape
+        x0, y0 = np.clip(np.floor(quad.min(0)).astype(np.int32), 0, [width, height])
+        x1, y1 = np.clip(np.ceil(quad.max(0)).astype(np.int32), 0, [width, height])
+        if(x1 - x0 < 8 or y1 - y0 < 8):
+            return
+        mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv.fillConvexPoly(mask, np.int32(quad - [x0, y0]), 255)
+        for x, y in np.int32(self.pts.reshape(-1,2) - [x0, y0]):
+            cv.circle(mask, (int(x), int(y)), self.feature_params['minDistance'], 0, -1)
+        self.full = len(self.pts)
+        pts = cv.goodFeaturesToTrack(gray_img[y0:y1, x0:x1], self.BUDGET, mask=mask, **self.feature_params)
+        if(pts is None):
+            return
+        pts = pts + np.float32([x0, y0])
+        marker_pts = cv.perspectiveTransform(pts, np.linalg.inv(H))
+        # strongest corners first, as many per cell as its share of the budget
+        capacity = self.BUDGET // (self.GRID[0] * self.GRID[1])
+        counts = np.bincount(self.cells(self.marker_pts), minlength=self.GRID[0] * self.GRID[1])
+        keep = []
+        for i, cell in enumerate(self.cells(marker_pts)):
+            if(counts[cell] < capacity):
+                counts[cell] += 1
+                keep.append(i)
+        self.pts = np.concatenate([self.pts, pts[keep]])
+        self.marker_pts = np.concatenate([self.marker_pts, marker_pts[keep]])
+        self.full = len(self.pts)
+
+class Relocalization:
+    feature_params = dict(
+        maxCorners = 300,
+        qualityLevel = 0.01,
+        minDistance = 10,
+        blockSize = 7)
+
+    def __init__(self, future, frame):
+        self.future = future
+        self.frame = frame
+        self.gray_img = frame.gray_img
+        self.src_pts = cv.goodFeaturesToTrack(frame.gray_img, **self.feature_params)
+        if(self.src_pts is None):
+            self.src_pts = np.zeros((0,1,2), np.float32)
+        self.dst_pts = self.src_pts
+
+    def track(self, frame, lk_params):
+        if(len(self.src_pts) < 4):
+            self.src_pts = self.dst_pts = np.zeros((0,1,2), np.float32)
+            self.gray_img = frame.gray_img
+            return
+        pts, st, err = cv.calcOpticalFlowPyrLK(self.gray_img, frame.gray_img, self.dst_pts, None, **lk_params)
+        st = st.ravel() == 1
+        self.src_pts, self.dst_pts = self.src_pts[st], pts[st]
+        self.gray_img = frame.gray_img
+
+    def motion(self):
+        # homography from the snapshot to the last tracked frame
+        if(self.gray_img is self.frame.gray_img):
+            return np.eye(3)
+        if(len(self.src_pts) < 4):
+            return None
+        F, _ = cv.findHomography(self.src_pts, self.dst_pts, cv.RANSAC, 5.0)
+        return F
+
+class MarkerPyramid:
+    # ORB features of the marker at several resolutions with every keypoint
+    # in marker pixels; the level of scale s suits frames showing the marker
+    # at about s frame pixels per marker pixel. Levels above 1 need a more
+    # detailed image of the marker and are skipped without one
+    ARRAYS = ['size', 'gray', 'corners', 'scales', 'offsets', 'pts', 'des']
+    SCALES = [2, 1, 0.5, 0.25]
+
+    def __init__(self, marker_img, detail_img=None):
+        h, w = marker_img.shape[:2]
+        self.size = np.int32([w, h])
+        # corners of the full resolution marker refine coarse homographies
+        self.gray = FeatureExtraction(marker_img).gray_img
+        self.corners = cv.goodFeaturesToTrack(self.gray, 500, 0.01, 10)
+        if(self.corners is None):
+            self.corners = np.zeros((0,1,2), np.float32)
+        R, native = self.register(marker_img, detail_img)
+        scales, pts, des = [], [], []
+        for scale in self.SCALES:
+            if(scale > 1):
+                if(R is None or native < scale):
+                    continue
+                # features of the detailed image, mapped back to the marker
+                # and limited to its extent
+                f = scale / native
+                level = FeatureExtraction(cv.resize(detail_img, None, fx=f, fy=f, interpolation=cv.INTER_AREA))
+                level.detect_and_compute()
+                if(level.des is None):
+                    continue
+                level_pts = cv.perspectiveTransform(cv.KeyPoint_convert(level.kps).reshape(-1,1,2) / f, R).reshape(-1,2)
+                inside = (level_pts >= 0).all(1) & (level_pts[:,0] < w) & (level_pts[:,1] < h)
+                level_pts, level_des = level_pts[inside], level.des[inside]
+            else:
+                img = marker_img if scale == 1 else cv.resize(marker_img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+                level = FeatureExtraction(img)
+                level.detect_and_compute()
+                if(level.des is None):
+                    continue
+                level_pts, level_des = cv.KeyPoint_convert(level.kps).reshape(-1,2) / scale, level.des
+            scales.append(scale)
+            pts.append(level_pts)
+            des.append(level_des)
+        self.scales = np.float32(scales)
+        self.offsets = np.zeros(len(scales) + 1, np.int32)
+        self.offsets[1:] = np.cumsum([len(p) for p in pts])
+        self.pts = np.float32(np.concatenate(pts)).reshape(-1,2)
+        self.des = np.uint8(np.concatenate(des)).reshape(-1,32)
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        pyramid = cls.__new__(cls)
+        for k in cls.ARRAYS:
+            setattr(pyramid, k, arrays[k])
+        return pyramid
+
+    def arrays(self):
+        return { k: getattr(self, k) for k in self.ARRAYS }
+
+    def register(self, marker_img, detail_img):
+        # homography from the detailed image to the marker and the detailed
+        # image pixels per marker pixel
+        if(detail_img is None):
+            return None, 0
+        h, w = marker_img.shape[:2]
+        f = min(1, 2 * w / detail_img.shape[1])
+        marker = FeatureExtraction(marker_img)
+        detail = FeatureExtraction(cv.resize(detail_img, None, fx=f, fy=f, interpolation=cv.INTER_AREA))
+        marker.detect_and_compute()
+        detail.detect_and_compute()
+        if(marker.des is None or detail.des is None):
+            return None, 0
+        matches = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True).match(detail.des, marker.des)
+        if(len(matches) < Tracking.min_matches):
+            return None, 0
+        src = np.float32([ detail.kps[m.queryIdx].pt for m in matches ]).reshape(-1,1,2) / f
+        dst = np.float32([ marker.kps[m.trainIdx].pt for m in matches ]).reshape(-1,1,2)
+        R, mask = cv.findHomography(src, dst, cv.RANSAC, 5.0)
+        if(R is None or mask.sum() < Tracking.min_matches):
+            return None, 0
+        return R, 1 / np.sqrt(abs(np.linalg.det(R[:2,:2])))
+
+    def level(self, scale):
+        # pts and des of the level with this scale, None when there is none
+        i = np.flatnonzero(self.scales == scale)
+        if(not len(i)):
+            return None
+        start, end = self.offsets[i[0]], self.offsets[i[0]+1]
+        return self.pts[start:end], self.des[start:end]
+
+class MarkerIndex:
+    # one FLANN index per pyramid scale over the descriptors of every
+    # target, so a frame is matched once per scale however many targets
+    # there are; owners maps each indexed descriptor back to its target
+    def __init__(self, markers):
+        self.markers = markers
+        self.scales = sorted({ s for m in markers for s in m.scales.tolist() }, reverse=True)
+        # FLANN indices can't be serialized, they are built on first use
+        self._levels = [None] * len(self.scales)
+
+    def prepare(self):
+        # builds every index ahead of the first relocalization
+        for level in range(len(self.scales)):
+            self.level(level)
+
+    def levels(self, scale):
+        # levels from the closest to the farthest to scale, in octaves
+        return np.argsort(np.abs(np.log2(np.float32(self.scales) / scale)), kind='stable').tolist()
+
+    def level(self, level):
+        if(self._levels[level] is None):
+            pts, des, owners = [], [], []
+            for target, marker in enumerate(self.markers):
+                features = marker.level(self.scales[level])
+                if(features is not None):
+                    pts.append(features[0])
+                    des.append(features[1])
+                    owners.append(np.full(len(features[0]), target, np.int32))
+            matcher = cv.FlannBasedMatcher(Tracking.index_params, Tracking.search_params)
+            matcher.add([np.ascontiguousarray(np.concatenate(des))])
+            matcher.train()
+            self._levels[level] = matcher, np.concatenate(pts), np.concatenate(owners)
+        return self._levels[level]
+
 class FeatureExtraction:
     orb = cv.ORB_create(
         nfeatures=5000,
         scaleFactor=1.1,
         scoreType=cv.ORB_FAST_SCORE)
+    # fewer features for the guided searches, the marker should be there
+    guided_orb = cv.ORB_create(
+        nfeatures=2500,
+        scaleFactor=1.1,
+        scoreType=cv.ORB_FAST_SCORE)
 
-    def __init__(self, img):
-        self.img = copy.copy(img)
-        self.gray_img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    def __init__(self, img, gray_img=None):
+        # gray_img is an optional buffer for the gray conversion
+        with PROFILER.stage('gray'):
+            self.gray_img = cv.cvtColor(img, cv.COLOR_BGR2GRAY, gray_img)
         self.kps, self.des = [], None
-        self.pts = []
-        self.matched_pts = []
-
-    def detect_and_compute(self):
-        self.kps = self.orb.detect(self.gray_img, None)
-        self.kps, self.des = self.orb.compute(self.gray_img, self.kps)
 
-    def convert_kps(self):
-        self.pts = cv.KeyPoint_convert(self.kps)
+    def detect_and_compute(self, roi=None, downscale=1):
+        # roi is (x0, y0, x1, y1), the keypoints are in frame pixels anyway
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, self.gray_img.shape[1], self.gray_img.shape[0])
+        img = self.gray_img[y0:y1, x0:x1]
+        if(downscale > 1):
+            img = cv.resize(img, None, fx=1/downscale, fy=1/downscale, interpolation=cv.INTER_AREA)
+        orb = self.orb if roi is None else self.guided_orb
+        self.kps = orb.detect(img, None)
+        self.kps, self.des = orb.compute(img, self.kps)
+        if(roi is not None or downscale > 1):
+            for kp in self.kps:
+                kp.pt = (kp.pt[0] * downscale + x0, kp.pt[1] * downscale + y0)
+                kp.size *= downscale